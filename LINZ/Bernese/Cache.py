@@ -0,0 +1,137 @@
+'''
+Optional persistent cache of parsed Bernese files.
+
+The readers in this package store the arrays parsed from a file in a .npz 
+file in the cache directory.  The cache key is built from the absolute file
+name, its modification time and size, the type of file, the reader options,
+and FORMAT_VERSION, so a cached result is not used if the file has changed or
+the parsed format has been changed.  The total size of the cache is limited
+by deleting the least recently used entries.
+
+The cache is disabled by default.  It is enabled by calling enable, or by 
+setting the environment variable BERNESE_PARSE_CACHE to the cache directory.
+'''
+
+import hashlib
+import os
+import os.path
+import tempfile
+import numpy as np
+
+from . import Instrument
+
+# Increment this when the arrays returned by the readers change
+FORMAT_VERSION=1
+
+_cachedir=None
+_maxsize=0
+
+def enable( cachedir=None, maxSize=512*1024*1024 ):
+    '''
+    Enable caching of parsed files
+
+    cachedir - the cache directory (default ~/.cache/linz-bernese)
+    maxSize - the maximum total size in bytes of the cached files
+    '''
+    global _cachedir, _maxsize
+    if not cachedir:
+        cachedir=os.path.join(os.path.expanduser('~'),'.cache','linz-bernese')
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    _cachedir=cachedir
+    _maxsize=maxSize
+
+def disable():
+    '''
+    Disable caching of parsed files
+    '''
+    global _cachedir
+    _cachedir=None
+
+def enabled():
+    return _cachedir is not None
+
+def clear():
+    '''
+    Delete all the files in the cache
+    '''
+    for path, size, mtime in _entries():
+        _remove(path)
+
+def cached( filetype, filename, loader, **options ):
+    '''
+    Return the dictionary of numpy arrays for a file, either from the cache 
+    or by calling loader(filename,**options).  The arrays must not be object
+    arrays.
+    '''
+    if _cachedir is None:
+        return loader(filename,**options)
+    stat=os.stat(filename)
+    key=repr((filetype,FORMAT_VERSION,os.path.abspath(filename),
+              getattr(stat,'st_mtime_ns',stat.st_mtime),stat.st_size,
+              sorted(options.items())))
+    path=os.path.join(_cachedir,
+                      filetype+'-'+hashlib.sha1(key.encode('utf8')).hexdigest()+'.npz')
+    try:
+        with Instrument.stage('cache'):
+            with np.load(path,allow_pickle=False) as data:
+                arrays={k: data[k] for k in data.files}
+            # Update the modification time to record use for LRU eviction
+            os.utime(path,None)
+        Instrument.count(cachehits=1)
+        return arrays
+    except (IOError,OSError,ValueError):
+        pass
+    arrays=loader(filename,**options)
+    with Instrument.stage('cache'):
+        _store(path,arrays)
+    return arrays
+
+def _store( path, arrays ):
+    tmppath=None
+    try:
+        fh, tmppath=tempfile.mkstemp(suffix='.tmp',dir=_cachedir)
+        with os.fdopen(fh,'wb') as f:
+            np.savez(f,**arrays)
+        os.replace(tmppath,path)
+    except (IOError,OSError,ValueError):
+        if tmppath is not None:
+            _remove(tmppath)
+        return
+    _evict()
+
+def _entries():
+    entries=[]
+    if _cachedir is None:
+        return entries
+    for f in os.listdir(_cachedir):
+        if not f.endswith('.npz'):
+            continue
+        path=os.path.join(_cachedir,f)
+        try:
+            stat=os.stat(path)
+        except OSError:
+            continue
+        entries.append((path,stat.st_size,stat.st_mtime))
+    return entries
+
+def _evict():
+    entries=_entries()
+    total=sum(e[1] for e in entries)
+    if total <= _maxsize:
+        return
+    entries.sort(key=lambda e: e[2])
+    for path, size, mtime in entries:
+        if total <= _maxsize:
+            break
+        _remove(path)
+        total -= size
+
+def _remove( path ):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+if os.environ.get('BERNESE_PARSE_CACHE'):
+    enable(os.environ['BERNESE_PARSE_CACHE'])
@@ -0,0 +1,283 @@
+'''
+Catalogue of the files in Bernese campaign directories.
+
+A catalogue scans the data directories of a campaign (by default STA, OUT,
+SOL and ATM) and records each file's type (extension), size, modification
+time, date, and for station and residual files (CRD, VEL, CLU, FIX, RES,
+FRS) the stations it contains in a small SQLite database.  Rescanning only reads files that are
+new or have changed, and removes files that no longer exist.
+
+The date of a file is taken from the header for coordinate (CRD, VEL) and
+residual (RES, FRS) files, otherwise from the file name (see filenameDate),
+which may contain the date as YYYYDDD or YYDDD followed by a session
+character, or the GPS week and day of week of CODE and IGS products.
+
+For example
+
+    cat=Catalogue.Catalogue()
+    cat.scan()
+    files=cat.files('CRD',station='WGTN',start=datetime.date(2025,1,1),
+                    end=datetime.date(2025,12,31))
+'''
+
+import datetime
+import os
+import os.path
+import re
+import sqlite3
+
+from . import Util
+
+# Campaign directories scanned by default
+defaultDirectories=('STA','OUT','SOL','ATM')
+
+_schema='''
+create table if not exists files (
+    path text primary key,
+    campaign text,
+    directory text,
+    filetype text,
+    mtime real,
+    size integer,
+    date text
+    );
+create index if not exists files_type on files( campaign, filetype, date );
+create table if not exists stations (
+    path text,
+    code text,
+    name text
+    );
+create index if not exists stations_path on stations( path );
+create index if not exists stations_code on stations( code );
+create index if not exists stations_name on stations( name );
+'''
+
+def _filetype( filename ):
+    name=re.sub(r'\.(gz|bz2|Z)$','',os.path.basename(filename))
+    ext=os.path.splitext(name)[1]
+    return ext[1:].upper()
+
+def _yeardoy( year, doy ):
+    if year < 100:
+        year += 1900 if year >= 80 else 2000
+    if year < 1980 or year > 2099 or doy < 1 or doy > 366:
+        return None
+    try:
+        date=datetime.date(year,1,1)+datetime.timedelta(days=doy-1)
+    except (ValueError,OverflowError):
+        return None
+    return date if date.year == year else None
+
+_gpsEpoch=datetime.date(1980,1,6)
+
+def filenameDate( filename ):
+    '''
+    Returns the date encoded in a Bernese file name, or None if there is no
+    date.  A run of 7 or more digits is read as YYYYDDD (followed by
+    optional session digits).  A run of 6 digits, or of 5 digits followed
+    by a session character, is read as YYDDD.  A run of 5 digits ending
+    the name is a GPS week and day of week (7 for a weekly file), as used
+    by CODE and IGS products.  For example
+
+    >>> filenameDate('FIN_20250010.CRD')
+    datetime.date(2025, 1, 1)
+    >>> filenameDate('FIN_2025032.CRD.gz')
+    datetime.date(2025, 2, 1)
+    >>> filenameDate('F1_250320.CRD')
+    datetime.date(2025, 2, 1)
+    >>> filenameDate('RES25032A.RES')
+    datetime.date(2025, 2, 1)
+    >>> filenameDate('COD22230.ION')
+    datetime.date(2022, 8, 14)
+    >>> filenameDate('SESSIONS.SES') is None
+    True
+    '''
+    name=re.sub(r'\.(gz|bz2|Z)$','',os.path.basename(filename))
+    name=os.path.splitext(name)[0]
+    for match in re.finditer(r'\d{5,}',name):
+        digits=match.group()
+        date=None
+        if len(digits) >= 7:
+            date=_yeardoy(int(digits[:4]),int(digits[4:7]))
+        elif len(digits) == 6 or match.end() < len(name):
+            date=_yeardoy(int(digits[:2]),int(digits[2:5]))
+        elif digits[4] <= '7':
+            date=_gpsEpoch+datetime.timedelta(days=int(digits[:4])*7+int(digits[4])%7)
+        if date is not None:
+            return date
+    return None
+
+def _readStationFile( filename, filetype ):
+    # Returns the date from the header (or None) and a list of station names
+    from . import CoordFile
+    from . import ClusterFile
+    from . import FixFile
+    from . import Residuals
+    if filetype in ('CRD','VEL'):
+        crd=CoordFile._readCoordArrays(filename,skipError=True)
+        match=re.match(r'(\d{4})\-(\d\d)-(\d\d)',str(crd['epoch']))
+        date=datetime.date(*(int(x) for x in match.groups())) if match else None
+        return date, crd['data']['name'].tolist()
+    if filetype == 'CLU':
+        return None, list(ClusterFile.read(filename))
+    if filetype == 'FIX':
+        return None, [s.name for s in FixFile.read(filename)]
+    if filetype in ('RES','FRS'):
+        with Util.openfile(filename) as f:
+            arrays, offsets = Residuals._readHeader(f,filename)
+        match=re.match(r'(\d{4})\-(\d\d)-(\d\d)',str(arrays['obsdate']))
+        date=datetime.date(*(int(x) for x in match.groups())) if match else None
+        names=set()
+        for code, name in (('line_code1','line_st1'),('line_code2','line_st2')):
+            for c, n in zip(arrays[code].tolist(),arrays[name].tolist()):
+                if c:
+                    names.add((c+' '+n).strip())
+        return date, sorted(names)
+    return None, []
+
+class Catalogue( object ):
+    '''
+    Catalogue of the files in a campaign.  campaign is the campaign
+    directory (default the active campaign).  dbfile is the SQLite database
+    file, by default catalogue.sqlite in ~/.cache/linz-bernese.  A database
+    can hold the catalogues of several campaigns.
+    '''
+
+    def __init__( self, campaign=None, dbfile=None ):
+        campaign=Util.expandpath(campaign) if campaign else Util.activecampaign()
+        if not campaign:
+            raise RuntimeError('No campaign specified and no active campaign defined')
+        self.campaign=os.path.abspath(campaign)
+        if dbfile is None:
+            cachedir=os.path.join(os.path.expanduser('~'),'.cache','linz-bernese')
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir)
+            dbfile=os.path.join(cachedir,'catalogue.sqlite')
+        self.dbfile=dbfile
+        self._db=sqlite3.connect(dbfile)
+        self._db.executescript(_schema)
+
+    def close( self ):
+        self._db.close()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.close()
+
+    def scan( self, directories=None ):
+        '''
+        Scan the campaign directories (default defaultDirectories) and update
+        the catalogue.  Returns a dictionary of the numbers of files added,
+        updated, removed, and unchanged.
+        '''
+        directories=directories or defaultDirectories
+        db=self._db
+        known={}
+        for path, mtime, size in db.execute(
+                'select path, mtime, size from files where campaign=?',(self.campaign,)):
+            known[path]=(mtime,size)
+        counts={'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+        found=set()
+        with db:
+            for directory in directories:
+                dirpath=os.path.join(self.campaign,directory)
+                if not os.path.isdir(dirpath):
+                    continue
+                for root, dirs, files in os.walk(dirpath):
+                    for f in files:
+                        path=os.path.join(root,f)
+                        try:
+                            stat=os.stat(path)
+                        except OSError:
+                            continue
+                        found.add(path)
+                        if known.get(path) == (stat.st_mtime,stat.st_size):
+                            counts['unchanged'] += 1
+                            continue
+                        counts['updated' if path in known else 'added'] += 1
+                        self._addFile(path,directory,stat)
+            for path in set(known)-found:
+                db.execute('delete from files where path=?',(path,))
+                db.execute('delete from stations where path=?',(path,))
+                counts['removed'] += 1
+        return counts
+
+    def _addFile( self, path, directory, stat ):
+        filetype=_filetype(path)
+        date=None
+        stations=[]
+        try:
+            date, stations = _readStationFile(path,filetype)
+        except Exception:
+            pass
+        date=date or filenameDate(path)
+        db=self._db
+        db.execute('delete from stations where path=?',(path,))
+        db.execute('insert or replace into files values (?,?,?,?,?,?,?)',
+                   (path,self.campaign,directory,filetype,stat.st_mtime,stat.st_size,
+                    date.isoformat() if date else None))
+        db.executemany('insert into stations values (?,?,?)',
+                       [(path,name[:4],name) for name in stations])
+
+    def files( self, filetype=None, station=None, start=None, end=None, directory=None ):
+        '''
+        Returns a list of the files in the catalogue, ordered by date and
+        file name, optionally selected by file type (for example 'CRD'),
+        station (code or full name), date range (dates inclusive, files
+        without a date are excluded if either is specified), and campaign
+        directory (for example 'STA').
+        '''
+        query=['select distinct f.path from files f']
+        where=['f.campaign=?']
+        params=[self.campaign]
+        if station is not None:
+            query.append('join stations s on s.path=f.path')
+            where.append('(s.code=? or s.name=?)')
+            params.extend((station,station))
+        if filetype is not None:
+            where.append('f.filetype=?')
+            params.append(filetype.upper())
+        if directory is not None:
+            where.append('f.directory=?')
+            params.append(directory)
+        if start is not None:
+            where.append('f.date>=?')
+            params.append(start.isoformat()[:10])
+        if end is not None:
+            where.append('f.date<=?')
+            params.append(end.isoformat()[:10])
+        query.append('where '+' and '.join(where))
+        query.append('order by f.date, f.path')
+        return [r[0] for r in self._db.execute(' '.join(query),params)]
+
+    def fileinfo( self, path ):
+        '''
+        Returns a dictionary of the catalogue information for a file (path,
+        directory, filetype, mtime, size, date, and stations), or None if it
+        is not in the catalogue
+        '''
+        path=os.path.abspath(path)
+        row=self._db.execute('select path, directory, filetype, mtime, size, date from files where path=?',
+                             (path,)).fetchone()
+        if row is None:
+            return None
+        info=dict(zip(('path','directory','filetype','mtime','size','date'),row))
+        if info['date']:
+            info['date']=datetime.date(*(int(x) for x in info['date'].split('-')))
+        info['stations']=self.stations(path)
+        return info
+
+    def stations( self, path=None ):
+        '''
+        Returns a sorted list of the station names in a file, or in all
+        files of the campaign if path is None
+        '''
+        if path is not None:
+            rows=self._db.execute('select distinct name from stations where path=? order by name',
+                                  (os.path.abspath(path),))
+        else:
+            rows=self._db.execute('select distinct s.name from stations s join files f on s.path=f.path '+
+                                  'where f.campaign=? order by s.name',(self.campaign,))
+        return [r[0] for r in rows]
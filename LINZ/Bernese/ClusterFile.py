@@ -1,16 +1,163 @@
 from collections import namedtuple
+import numpy as np
+
 from . import Util
+from . import Cache
+from . import Instrument
 from .Fortran import Format
 
 StationCluster=namedtuple('StationCluster','code name clusters')
+ClusterLoad=namedtuple('ClusterLoad','cluster stations overlap baselines length maxLength')
+
+_clufmt=Format('A16,I5','name cluster',True)
+
+def _readClusterArrays( filename ):
+    return {'data': _clufmt.readfilearray(filename,skipLines=5,skipBlanks=True)}
 
+@Instrument.instrumented('ClusterFile.read')
 def read( f ):
     clusters={}
-    clufmt=Format('A16,I5','name cluster',True)
-    for data in clufmt.readfile(Util.expandpath(f),skipLines=5,skipBlanks=True):
-        if data.name in clusters:
-            clusters[data.name].clusters.append(data.cluster)
+    data=Cache.cached('CLU',Util.expandpath(f),_readClusterArrays)['data']
+    for name, cluster in zip(data['name'].tolist(),data['cluster'].tolist()):
+        if name in clusters:
+            clusters[name].clusters.append(cluster)
+        else:
+            clusters[name]=StationCluster(name[:4],name,[cluster])
+    return clusters
+
+def write( f, clusters, title=None, created=None ):
+    '''
+    Write a cluster file.  clusters is a dictionary keyed on station name of 
+    either StationCluster objects (as returned by read) or cluster numbers.
+    title is written at the top of the file with the created date (default now).
+    '''
+    names=[]
+    numbers=[]
+    for name, cluster in clusters.items():
+        cluster=getattr(cluster,'clusters',cluster)
+        if isinstance(cluster,(list,tuple)):
+            names.extend([name]*len(cluster))
+            numbers.extend(cluster)
         else:
-            clusters[data.name]=StationCluster(data.name[:4],data.name,[data.cluster])
+            names.append(name)
+            numbers.append(cluster)
+    with Util.openoutput(Util.expandpath(f)) as cf:
+        header=Util.headerlines(title,created)
+        header.extend(('','STATION NAME      CLU','****************  ***'))
+        cf.write('\n'.join(header)+'\n')
+        _clufmt.writearray(cf,(names,numbers))
+
+def _bisect( xyz, rows, nclusters, first, cluster ):
+    # Recursive coordinate bisection.  Splits rows along the axis of largest
+    # extent in proportion to the number of clusters on each side.
+    if nclusters == 1:
+        cluster[rows]=first
+        return
+    nleft=nclusters//2
+    pts=xyz[rows]
+    axis=np.argmax(pts.max(axis=0)-pts.min(axis=0))
+    nsplit=(len(rows)*nleft+nclusters//2)//nclusters
+    order=np.argpartition(pts[:,axis],nsplit) if 0 < nsplit < len(rows) else np.arange(len(rows))
+    _bisect(xyz,rows[order[:nsplit]],nleft,first,cluster)
+    _bisect(xyz,rows[order[nsplit:]],nclusters-nleft,first+nleft,cluster)
+
+def _nearestDistance( xyz, members, others, chunksize=1000000 ):
+    # Distance from each of others to the nearest of members
+    result=np.empty((len(others),))
+    step=max(1,chunksize//max(len(members),1))
+    mxyz=xyz[members]
+    for i in range(0,len(others),step):
+        oxyz=xyz[others[i:i+step]]
+        diff=oxyz[:,None,:]-mxyz[None,:,:]
+        result[i:i+step]=np.sqrt(np.einsum('ijk,ijk->ij',diff,diff).min(axis=1))
+    return result
+
+def generate( coords, nclusters, overlap=0 ):
+    '''
+    Generate nclusters spatially compact clusters of equal size (within one
+    station) from the stations of a CoordSet or dictionary of StationCoord
+    objects (as returned by CoordFile.read).  The stations are split by
+    recursive bisection of their XYZ coordinates.  If overlap is greater
+    than 0 then each cluster also includes that many of the stations of
+    other clusters nearest to it, which ties the clusters together when they
+    are combined.  Returns a dictionary keyed on station name of
+    StationCluster objects, as returned by read and accepted by write.
+    '''
+    from .CoordFile import CoordSet
+    coords=CoordSet.fromStations(coords)
+    nstations=len(coords)
+    if nclusters < 1:
+        raise ValueError('Number of clusters must be at least 1')
+    nclusters=min(nclusters,max(nstations,1))
+    cluster=np.zeros((nstations,),dtype=np.int64)
+    valid=np.flatnonzero(np.all(np.isfinite(coords.xyz),axis=1))
+    if len(valid) < nstations:
+        raise ValueError('Cannot generate clusters for stations without coordinates')
+    _bisect(coords.xyz,valid,nclusters,1,cluster)
+
+    names=coords.name.tolist()
+    clusters=dict((name,StationCluster(name[:4],name,[c])) for name, c in zip(names,cluster.tolist()))
+    if overlap > 0 and nclusters > 1:
+        for c in range(1,nclusters+1):
+            members=np.flatnonzero(cluster == c)
+            others=np.flatnonzero(cluster != c)
+            distance=_nearestDistance(coords.xyz,members,others)
+            nearest=others[np.argsort(distance,kind='stable')[:overlap]]
+            for row in nearest.tolist():
+                clusters[names[row]].clusters.append(c)
     return clusters
 
+def _spanningTree( xyz ):
+    # Lengths of the baselines of the shortest spanning tree (Prim's algorithm)
+    n=len(xyz)
+    if n < 2:
+        return np.zeros((0,))
+    intree=np.zeros((n,),dtype=bool)
+    intree[0]=True
+    distance=np.sqrt(np.sum((xyz-xyz[0])**2,axis=1))
+    distance[0]=np.inf
+    lengths=np.empty((n-1,))
+    for i in range(n-1):
+        row=np.argmin(distance)
+        lengths[i]=distance[row]
+        intree[row]=True
+        distance=np.minimum(distance,np.sqrt(np.sum((xyz-xyz[row])**2,axis=1)))
+        distance[intree]=np.inf
+    return lengths
+
+def clusterLoad( coords, clusters ):
+    '''
+    Report of the expected processing load of each cluster.  coords is a
+    CoordSet or dictionary of StationCoord objects, and clusters is a
+    dictionary of StationCluster objects, as returned by read or generate.
+    Returns a list of ClusterLoad, one for each cluster, with the numbers of
+    stations, overlap stations (also in other clusters) and baselines
+    (stations-1), and the total and maximum baseline lengths (metres) of the
+    shortest baseline network of the cluster.  Stations without coordinates
+    are counted but excluded from the baseline lengths.
+    '''
+    from .CoordFile import CoordSet
+    coords=CoordSet.fromStations(coords)
+    members={}
+    for name, sc in clusters.items():
+        for c in getattr(sc,'clusters',[sc]):
+            members.setdefault(c,[]).append(name)
+    loads=[]
+    for c in sorted(members):
+        names=members[c]
+        noverlap=sum(1 for n in names if len(getattr(clusters[n],'clusters',[c])) > 1)
+        rows=np.flatnonzero(np.isin(coords.name,names))
+        xyz=coords.xyz[rows]
+        xyz=xyz[np.all(np.isfinite(xyz),axis=1)]
+        lengths=_spanningTree(xyz)
+        loads.append(ClusterLoad(c,len(names),noverlap,max(len(names)-1,0),
+                                 float(lengths.sum()),float(lengths.max()) if len(lengths) else 0.0))
+    return loads
+
+def read_many( filenames, workers=None ):
+    '''
+    Read a list of files, returning a list of the results in the same order
+    as the files.  If workers is greater than 1 the files are parsed in a 
+    pool of that many processes (0 for one per CPU).
+    '''
+    return Util.mapfiles(read,filenames,workers=workers)
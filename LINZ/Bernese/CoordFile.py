@@ -6,22 +6,37 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 from collections import namedtuple
-import pandas as pd
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 import datetime
+import itertools
+import os
+import os.path
 import re
+import sys
 import numpy as np
-import numpy.linalg as la
-
-from LINZ.Geodetic.Ellipsoid import GRS80
 
 from . import Util
+from . import Cache
+from . import Helmert
+from . import Instrument
+from . import SpatialIndex
 from .Fortran import Format
 
+try:
+    basestring
+except NameError:
+    basestring=str
+
 class StationCoord( object ):
     '''
     Class representing station coordinate information read from Bernese station file
     '''
 
+    __slots__=('id','code','name','datum','crddate','xyz','vxyz','flag')
+
     def __init__(self, id, code, name, datum, crddate, xyz, vxyz, flag):
         self.id=id
         self.code=code
@@ -44,12 +59,346 @@ class StationCoord( object ):
         vxyz=self.vxyz
         return [xyz[0]+vxyz[0]*ydiff,xyz[1]+vxyz[1]*ydiff,xyz[2]+vxyz[2]*ydiff]
 
-def read( filename, velocityFilename=None, velocities=False, tryVelocities=False, skipError=False, useCode=False ):
+UpdateReport=namedtuple('UpdateReport','added moved flagChanged velocityChanged unchanged')
+
+class CoordSet( Mapping ):
+    '''
+    Columnar set of station coordinates read from a Bernese station file.
+
+    The station data are held in numpy arrays with one row per station:
+
+       id     station number
+       code   4 character station code
+       name   full station name
+       flag   station flag
+       xyz    N x 3 array of X,Y,Z coordinates
+       vxyz   N x 3 array of velocities, NaN where the station has no velocity
+
+    datum and crddate are common to all stations in the set.
+
+    The set also behaves as a read-only dictionary of StationCoord objects 
+    keyed on station name (or code if useCode is True), so it can be used 
+    wherever the dictionary returned by read is expected.
+    '''
+
+    def __init__( self, id, code, name, xyz, vxyz=None, flag=None, datum=None, crddate=None, useCode=False ):
+        xyz=np.array(xyz,dtype=np.float64).reshape((-1,3))
+        nstn=xyz.shape[0]
+        if vxyz is None:
+            vxyz=np.full((nstn,3),np.nan)
+        vxyz=np.array(vxyz,dtype=np.float64).reshape((-1,3))
+        if flag is None:
+            flag=['']*nstn
+        self.id=np.array(id,dtype=np.int64).reshape((nstn,))
+        self.code=np.array(code,dtype=str).reshape((nstn,))
+        self.name=np.array(name,dtype=str).reshape((nstn,))
+        self.flag=np.array(flag,dtype=str).reshape((nstn,))
+        self.xyz=xyz
+        self.vxyz=vxyz
+        self.datum=datum
+        self.crddate=crddate
+        self.useCode=useCode
+        keys=self.code if useCode else self.name
+        index={k: i for i, k in enumerate(keys.tolist())}
+        if len(index) < nstn:
+            # Duplicate keys - the last occurrence is used, as for a dictionary
+            rows=np.array(sorted(index.values()),dtype=np.int64)
+            for f in ('id','code','name','flag','xyz','vxyz'):
+                setattr(self,f,getattr(self,f)[rows])
+            keys=keys[rows]
+            index={k: i for i, k in enumerate(keys.tolist())}
+        self._keys=keys
+        self._index=index
+
+    def __getstate__( self ):
+        # The key index is rebuilt on unpickling to keep pickles compact
+        state=self.__dict__.copy()
+        del state['_index']
+        return state
+
+    def __setstate__( self, state ):
+        self.__dict__.update(state)
+        self._index={k: i for i, k in enumerate(self._keys.tolist())}
+
+    def __len__( self ):
+        return len(self._index)
+
+    def __iter__( self ):
+        return iter(self._keys.tolist())
+
+    def __contains__( self, key ):
+        return key in self._index
+
+    def __getitem__( self, key ):
+        return self.station(self._index[key])
+
+    @staticmethod
+    def fromStations( stations, useCode=False ):
+        '''
+        Create a CoordSet from a dictionary or list of StationCoord objects
+        '''
+        if isinstance(stations,CoordSet):
+            return stations
+        if isinstance(stations,Mapping):
+            stations=list(stations.values())
+        nanxyz=[np.nan,np.nan,np.nan]
+        datum=stations[0].datum if stations else None
+        crddate=stations[0].crddate if stations else None
+        return CoordSet(
+            [s.id for s in stations],
+            [s.code for s in stations],
+            [s.name for s in stations],
+            np.array([s.xyz for s in stations],dtype=np.float64).reshape((-1,3)),
+            np.array([s.vxyz or nanxyz for s in stations],dtype=np.float64).reshape((-1,3)),
+            [s.flag for s in stations],
+            datum=datum,crddate=crddate,useCode=useCode)
+
+    def hasVelocity( self ):
+        '''
+        Returns a boolean array identifying stations with velocities
+        '''
+        return ~np.isnan(self.vxyz[:,0])
+
+    def propagate( self, dates ):
+        '''
+        Calculate the coordinates of all stations at one or more dates,
+        using the same calculation as StationCoord.epochXyz.  Stations
+        without velocities keep their coordinates unchanged.
+
+        dates can be a single date, in which case an N x 3 array is returned,
+        or a list of dates, in which case an array of shape (ndates,N,3) is
+        returned.
+        '''
+        single=dates is None or isinstance(dates,datetime.date)
+        if single:
+            dates=[dates]
+        ydiff=np.array([0.0 if d is None or self.crddate is None
+                        else (d-self.crddate).days/365.242 for d in dates])
+        vxyz=np.where(self.hasVelocity()[:,np.newaxis],self.vxyz,0.0)
+        xyz=self.xyz[np.newaxis,:,:]+ydiff[:,np.newaxis,np.newaxis]*vxyz[np.newaxis,:,:]
+        return xyz[0] if single else xyz
+
+    def station( self, row ):
+        '''
+        Returns a StationCoord object for the station at a row of the set
+        '''
+        vxyz=self.vxyz[row]
+        return StationCoord(
+            int(self.id[row]),
+            str(self.code[row]),
+            str(self.name[row]),
+            self.datum,
+            self.crddate,
+            self.xyz[row].tolist(),
+            None if np.isnan(vxyz[0]) else vxyz.tolist(),
+            str(self.flag[row]))
+
+    def rows( self, keys ):
+        '''
+        Returns an array of the rows of the set for a list of keys.  
+        Keys not in the set are given row -1.
+        '''
+        index=self._index
+        return np.array([index.get(k,-1) for k in keys],dtype=np.int64)
+
+    def subset( self, keys ):
+        '''
+        Returns a new CoordSet containing just the specified keys (which must
+        all be in the set)
+        '''
+        rows=np.array([self._index[k] for k in keys],dtype=np.int64)
+        return CoordSet(self.id[rows],self.code[rows],self.name[rows],
+                        self.xyz[rows],self.vxyz[rows],self.flag[rows],
+                        datum=self.datum,crddate=self.crddate,useCode=self.useCode)
+
+    def update( self, other, add=True, replace=True, tolerance=0.0, velocityTolerance=0.0 ):
+        '''
+        Update this set in place with the stations of another set (a CoordSet
+        or dictionary as returned by read), for example to apply a new CRD/VEL
+        file to a master station list.  Stations are matched on the keys of
+        this set.  
+
+        add - if True stations not already in the set are added
+        replace - if True the coordinates, flags, and velocities of 
+              existing stations are replaced.  Velocities are only replaced
+              for stations that have velocities in the other set.
+        tolerance - coordinate changes no greater than this (metres) are
+              reported as unchanged
+        velocityTolerance - as for tolerance, for velocities (metres/year)
+
+        If both sets have a coordinate epoch and these differ then the other
+        coordinates are first propagated to the epoch of this set.  Returns
+        an UpdateReport of the keys of the stations that were added, moved,
+        changed flag, changed velocity, and unchanged.
+        '''
+        other=CoordSet.fromStations(other,useCode=self.useCode)
+        otherxyz=other.xyz
+        if self.crddate is not None and other.crddate is not None and other.crddate != self.crddate:
+            otherxyz=other.propagate(self.crddate)
+        keys=other._keys
+        rows=self.rows(keys.tolist())
+        found=rows >= 0
+        frows=rows[found]
+
+        dxyz=otherxyz[found]-self.xyz[frows]
+        moved=np.sqrt(np.sum(dxyz*dxyz,axis=1)) > tolerance
+        flagged=other.flag[found] != self.flag[frows]
+        hasvel=other.hasVelocity()[found]
+        dvxyz=np.where(np.isnan(self.vxyz[frows]),np.inf,other.vxyz[found]-self.vxyz[frows])
+        velchanged=hasvel & (np.sqrt(np.sum(dvxyz*dvxyz,axis=1)) > velocityTolerance)
+        unchanged=~(moved | flagged | velchanged)
+
+        if replace:
+            if other.flag.dtype.itemsize > self.flag.dtype.itemsize:
+                self.flag=self.flag.astype(other.flag.dtype)
+            self.xyz[frows[moved]]=otherxyz[found][moved]
+            self.flag[frows]=other.flag[found]
+            self.vxyz[frows[velchanged]]=other.vxyz[found][velchanged]
+            self.id[frows]=other.id[found]
+        if add and not np.all(found):
+            new=~found
+            nstn=len(self._keys)
+            self.id=np.concatenate((self.id,other.id[new]))
+            self.code=np.concatenate((self.code,other.code[new]))
+            self.name=np.concatenate((self.name,other.name[new]))
+            self.flag=np.concatenate((self.flag,other.flag[new]))
+            self.xyz=np.concatenate((self.xyz,otherxyz[new]))
+            self.vxyz=np.concatenate((self.vxyz,other.vxyz[new]))
+            newkeys=keys[new]
+            self._keys=np.concatenate((self._keys,newkeys))
+            self._index.update((k,nstn+i) for i, k in enumerate(newkeys.tolist()))
+
+        fkeys=keys[found]
+        return UpdateReport(
+            keys[~found].tolist() if add else [],
+            fkeys[moved].tolist(),
+            fkeys[flagged].tolist(),
+            fkeys[velchanged].tolist(),
+            fkeys[unchanged].tolist())
+
+    def updateFromFile( self, filename, velocityFilename=None, tryVelocities=True, skipError=False, **options ):
+        '''
+        Update this set in place from a coordinate file and its velocity file
+        if it exists (see update for the options).  Returns an UpdateReport.
+        '''
+        other=read(filename,velocityFilename=velocityFilename,tryVelocities=tryVelocities,
+                   skipError=skipError,useCode=self.useCode,coordSet=True)
+        return self.update(other,**options)
+
+    def helmert( self, other, rejectFactor=None, rejectLimit=None ):
+        '''
+        Estimate the 7 parameter Helmert transformation from this set to 
+        another set of coordinates (a CoordSet or dictionary as returned by
+        read) using the stations common to both.  Returns a 
+        Helmert.HelmertFit with station arrays in the order of this set.
+        See Helmert.estimate for rejectFactor and rejectLimit.
+        '''
+        other=CoordSet.fromStations(other,useCode=self.useCode)
+        otherxyz=_stackSolutions([other],self._keys.tolist())[0]
+        return Helmert.estimate(self.xyz,otherxyz,rejectFactor=rejectFactor,rejectLimit=rejectLimit)
+
+    def spatialIndex( self, useTree=True ):
+        '''
+        Returns a SpatialIndex.SpatialIndex of the station coordinates, with
+        the keys of the set as its keys
+        '''
+        return SpatialIndex.SpatialIndex(self.xyz,self._keys,useTree=useTree)
+
+    def within( self, point, radius ):
+        '''
+        Returns a list of the keys of stations within radius metres of a
+        point, which may be an XYZ coordinate or the key of a station in the
+        set, ordered by distance
+        '''
+        if isinstance(point,basestring):
+            point=self.xyz[self._index[point]]
+        index=self.spatialIndex()
+        return index.keys(index.within(point,radius))
+
+    def nearest( self, point, k=1, maxDistance=None ):
+        '''
+        Returns a list of (key, distance) of the k stations nearest to a
+        point, which may be an XYZ coordinate or the key of a station in the
+        set (in which case the station itself is excluded), within
+        maxDistance metres if it is specified
+        '''
+        exclude=-1
+        if isinstance(point,basestring):
+            exclude=self._index[point]
+            point=self.xyz[exclude]
+        distance, rows = self.spatialIndex().nearest(point,k=k+1,maxDistance=maxDistance)
+        keep=(rows >= 0) & (rows != exclude)
+        rows=rows[keep][:k]
+        distance=distance[keep][:k]
+        return list(zip(self._keys[rows].tolist(),distance.tolist()))
+
+    def transform( self, params ):
+        '''
+        Returns a new CoordSet with the coordinates transformed by Helmert
+        transformation parameters (see Helmert.apply)
+        '''
+        return CoordSet(self.id,self.code,self.name,Helmert.apply(params,self.xyz),
+                        self.vxyz,self.flag,datum=self.datum,crddate=self.crddate,
+                        useCode=self.useCode)
+
+_dtmfmt=Format('22X,A18,7X,A20','datum epoch',True)
+_crdfmt=Format('I3,2X,A16,3F15.4,4X,A1','id name X Y Z flag',True)
+
+def _readCoordArrays( filename, skipError=False ):
+    '''
+    Parse a coordinate file into a dictionary of arrays: data (the station
+    records), datum, and epoch
+    '''
+    f=Util.openfile(filename)
+    try:
+        # Skip two header lines
+        f.readline()
+        f.readline()
+        # Read datum line
+        dtm=_dtmfmt.read(f.readline())
+        # Skip the column header so that it is not counted as an invalid record
+        lines=[f.readline() for i in range(3)]
+        lines=[l for l in lines if not re.match(r'\s*(NUM\s+STATION|$)',l)]
+        data=None
+        try:
+            data=_crdfmt.readarray(itertools.chain(lines,f),skipBlanks=True,skipErrors=True)
+        except:
+            if not skipError:
+                raise
+        if data is None:
+            data=np.empty((0,),dtype=_crdfmt.dtype)
+    finally:
+        f.close()
+    return {'data': data, 'datum': np.array(dtm.datum), 'epoch': np.array(dtm.epoch)}
+
+def _readVelocityArrays( filename ):
+    '''
+    Parse a velocity file into a dictionary with the station records as data
+    '''
+    data=_crdfmt.readfilearray(filename,skipLines=6,skipBlanks=True,skipErrors=True)
+    return {'data': data}
+
+def _parseEpoch( epoch, filename ):
+    match=re.match(r'(\d{4})\-(\d\d)-(\d\d)\s+(\d\d)\:(\d\d)\:(\d\d)',epoch)
+    if match is None:
+        raise RuntimeError('Invalid datum epoch '+epoch+' in '+filename)
+    year,mon,day,hour,min,sec=(int(x) for x in match.groups())
+    return datetime.datetime(year,mon,day,hour,min,sec)
+
+def _velocityFilename( filename ):
+    return re.sub(r'(?:\.CRD((?:\.gz|\.bz2|\.Z)?))?$',r'.VEL\1',filename,count=1)
+
+@Instrument.instrumented('CoordFile.read')
+def read( filename, velocityFilename=None, velocities=False, tryVelocities=False, skipError=False, useCode=False, coordSet=False, lazy=False ):
     '''
     Read a bernese coordinate file and returns a dictionary of StationData
     keyed on station code.  If velocities is True then a matching .VEL file will be loaded.
     If tryVelocities is True then a velocity file will be tried, but the routine will not fail
     if it cannot be read.  If velocityFilename is specified then a velocity file will be loaded.  
+
+    If coordSet is True then the data are returned as a CoordSet rather than 
+    a dictionary.  If lazy is True then a LazyCoordFile is returned which 
+    only parses the stations that are accessed.
     '''
 
     filename=Util.expandpath(filename)
@@ -57,56 +406,265 @@ def read( filename, velocityFilename=None, velocities=False, tryVelocities=False
     if tryVelocities or velocityFilename is not None:
         velocities=True
 
-    dtmfmt=Format('22X,A18,7X,A20','datum epoch',True)
-    crdfmt=Format('I3,2X,A16,3F15.4,4X,A1','id name X Y Z flag',True)
+    if lazy:
+        if velocities and velocityFilename is None:
+            velocityFilename=_velocityFilename(filename)
+            if tryVelocities and not os.path.exists(velocityFilename):
+                velocityFilename=None
+        return LazyCoordFile(filename,velocityFilename=velocityFilename if velocities else None,useCode=useCode)
 
-    veldata={}
+    veldata=None
     if velocities:
         try:
             if velocityFilename is None:
-                velocityFilename=re.sub(r'(?:\.CRD((?:\.gz)?))?$',r'.VEL\1',filename)
-            for data in crdfmt.readfile(velocityFilename,skipLines=6,skipBlanks=True,skipErrors=True):
-                code=data.name[:4]
-                key=code if useCode else data.name
-                veldata[key]=[data.X,data.Y,data.Z]
+                velocityFilename=_velocityFilename(filename)
+            veldata=Cache.cached('VEL',velocityFilename,_readVelocityArrays)['data']
         except:
             if not tryVelocities:
                 raise
 
-    coords={}
-    
-    if filename.endswith('.gz'):
-        import gzip
-        f=gzip.open(filename,'rb')
-    else:
-        f=open(filename)
-    try:
-        # Skip two header lines
-        f.readline()
-        f.readline()
-        # Read datum line
-        dtm=dtmfmt.read(f.readline())
-        datum=dtm.datum
-        match=re.match(r'(\d{4})\-(\d\d)-(\d\d)\s+(\d\d)\:(\d\d)\:(\d\d)',dtm.epoch)
-        if match is None:
-            raise RuntimeError('Invalid datum epoch '+dtm.epoch+' in '+filename)
-        year,mon,day,hour,min,sec=(int(x) for x in match.groups())
-        crddate=datetime.datetime(year,mon,day,hour,min,sec)
-        try:
-            for data in crdfmt.readiter(f,skipBlanks=True,skipErrors=True):
-                code=data.name[:4]
-                key=code if useCode else data.name
-                xyz=[data.X,data.Y,data.Z]
-                vxyz=veldata.get(key)
-                coords[key]=StationCoord(data.id,code,data.name,datum,crddate,xyz,vxyz,data.flag)
-        except:
-            if not skipError:
-                raise
-    finally:
-        f.close()
+    crd=Cache.cached('CRD',filename,_readCoordArrays,skipError=skipError)
+    data=crd['data']
+    datum=str(crd['datum'])
+    crddate=_parseEpoch(str(crd['epoch']),filename)
+
+    with Instrument.stage('build'):
+        xyz=np.column_stack((data['X'],data['Y'],data['Z']))
+        coords=CoordSet(data['id'],data['name'].astype('U4'),data['name'],xyz,
+                        flag=data['flag'],datum=datum,crddate=crddate,useCode=useCode)
+        if veldata is not None and len(veldata) > 0:
+            velkeys=veldata['name']
+            if useCode:
+                velkeys=velkeys.astype('U4')
+            velindex={k: i for i, k in enumerate(velkeys.tolist())}
+            rows=np.array([velindex.get(k,-1) for k in coords._keys.tolist()],dtype=np.int64)
+            found=rows >= 0
+            vxyz=np.column_stack((veldata['X'],veldata['Y'],veldata['Z']))
+            coords.vxyz[found]=vxyz[rows[found]]
+        if not coordSet:
+            coords=dict(coords.items())
     return coords
 
-def compare( codes=None, codesCoordFile=None, useCode=False, velocities=False, skipError=False, **files ):
+def _writeFile( filename, coords, rows, values, colheader, title, created ):
+    with Util.openoutput(filename) as f:
+        header=Util.headerlines(title,created)
+        crddate=coords.crddate.strftime('%Y-%m-%d %H:%M:%S') if coords.crddate else ''
+        header.append('LOCAL GEODETIC DATUM: '+(coords.datum or '')[:18].ljust(18)+'EPOCH: '+crddate)
+        header.extend(('',colheader,''))
+        f.write('\n'.join(header)+'\n')
+        _crdfmt.writearray(f,(coords.id[rows] % 1000,coords.name[rows],
+                              values[rows,0],values[rows,1],values[rows,2],coords.flag[rows]))
+
+def write( filename, coords, title=None, created=None, velocities=False, velocityFilename=None ):
+    '''
+    Write a bernese coordinate file from a CoordSet or dictionary of 
+    StationCoord objects (as returned by read).  If velocities is True or
+    velocityFilename is specified then a velocity file is also written for
+    the stations that have velocities.  The default velocity file name is 
+    the coordinate file name with .CRD replaced with .VEL.  
+
+    title is written at the top of the file, with the created date (default
+    now).  Station numbers are written modulo 1000 to fit the I3 format.
+    '''
+    coords=CoordSet.fromStations(coords)
+    filename=Util.expandpath(filename)
+    _writeFile(filename,coords,np.arange(len(coords)),coords.xyz,
+               'NUM  STATION NAME           X (M)          Y (M)          Z (M)     FLAG',
+               title,created)
+    if velocities or velocityFilename is not None:
+        if velocityFilename is None:
+            velocityFilename=_velocityFilename(filename)
+        _writeFile(Util.expandpath(velocityFilename),coords,
+                   np.flatnonzero(coords.hasVelocity()),coords.vxyz,
+                   'NUM  STATION NAME           VX (M/Y)       VY (M/Y)       VZ (M/Y)  FLAG',
+                   title,created)
+
+@Instrument.instrumented('CoordFile.read_many')
+def read_many( filenames, workers=None, coordSet=True, **kwargs ):
+    '''
+    Read a list of bernese coordinate files, returning a list of the results
+    in the same order as the files.  Keyword arguments are as for read, 
+    except that by default CoordSets are returned.  If workers is greater 
+    than 1 the files are parsed in a pool of that many processes (0 for 
+    one per CPU).
+    '''
+    return Util.mapfiles(read,filenames,workers=workers,coordSet=coordSet,**kwargs)
+
+def _coordArrays( crddata, codes ):
+    '''
+    Returns arrays of XYZ, velocity, and flags for a list of codes from
+    either a CoordSet or a dictionary of StationCoord objects.  Missing 
+    velocities are returned as NaN.
+    '''
+    if isinstance(crddata,CoordSet):
+        rows=crddata.rows(codes)
+        return crddata.xyz[rows],crddata.vxyz[rows],crddata.flag[rows].astype(object)
+    stations=[crddata[c] for c in codes]
+    nanxyz=[np.nan,np.nan,np.nan]
+    xyz=np.array([s.xyz for s in stations],dtype=np.float64).reshape((-1,3))
+    vxyz=np.array([s.vxyz or nanxyz for s in stations],dtype=np.float64).reshape((-1,3))
+    flags=np.array([s.flag for s in stations],dtype=object)
+    return xyz,vxyz,flags
+
+# GRS80 ellipsoid semi-major axis and flattening
+_grs80a=6378137.0
+_grs80rf=298.257222101
+
+def _geodetic( xyz ):
+    '''
+    Returns arrays of GRS80 longitude and latitude (degrees, longitude from
+    0 to 360) and ellipsoidal height for an (N,3) array of XYZ coordinates
+    '''
+    xyz=np.asarray(xyz,dtype=np.float64).reshape((-1,3))
+    x,y,z=xyz[:,0],xyz[:,1],xyz[:,2]
+    e2=(2.0-1.0/_grs80rf)/_grs80rf
+    p=np.hypot(x,y)
+    lon=np.degrees(np.arctan2(y,x))
+    lon[lon < 0] += 360.0
+    lat=np.arctan2(z,p*(1.0-e2))
+    with np.errstate(invalid='ignore',divide='ignore'):
+        for i in range(6):
+            slt=np.sin(lat)
+            bsac=_grs80a/np.sqrt(1.0-e2*slt*slt)
+            lat=np.arctan2(z+e2*bsac*slt,p)
+        slt=np.sin(lat)
+        bsac=_grs80a/np.sqrt(1.0-e2*slt*slt)
+        hgt=p*np.cos(lat)+z*slt-bsac*(1.0-e2*slt*slt)
+    return lon, np.degrees(lat), hgt
+
+def _xyz( lon, lat, hgt ):
+    '''
+    Returns an (N,3) array of XYZ coordinates for arrays of GRS80 longitude
+    and latitude (degrees) and ellipsoidal height
+    '''
+    lon=np.radians(lon)
+    lat=np.radians(lat)
+    hgt=np.asarray(hgt,dtype=np.float64)
+    e2=(2.0-1.0/_grs80rf)/_grs80rf
+    slt=np.sin(lat)
+    bsac=_grs80a/np.sqrt(1.0-e2*slt*slt)
+    p=(bsac+hgt)*np.cos(lat)
+    return np.column_stack((p*np.cos(lon),p*np.sin(lon),(bsac*(1.0-e2)+hgt)*slt))
+
+def _enuAxes( lon, lat ):
+    '''
+    Returns an array of shape (N,3,3) of the east, north, and up unit vectors
+    on the GRS80 ellipsoid at arrays of longitudes and latitudes
+    '''
+    lon=np.radians(lon)
+    lat=np.radians(lat)
+    cln,sln=np.cos(lon),np.sin(lon)
+    clt,slt=np.cos(lat),np.sin(lat)
+    axes=np.empty((len(lon),3,3))
+    axes[:,0,0]=-sln
+    axes[:,0,1]=cln
+    axes[:,0,2]=0.0
+    axes[:,1,0]=-cln*slt
+    axes[:,1,1]=-sln*slt
+    axes[:,1,2]=clt
+    axes[:,2,0]=clt*cln
+    axes[:,2,1]=clt*sln
+    axes[:,2,2]=slt
+    return axes
+
+def _addColumns( data, columns, names, values ):
+    for i, name in enumerate(names):
+        data[name]=values[:,i]
+        columns.append(name)
+
+class LazyCoordFile( Mapping ):
+    '''
+    Lazy read-only access to the stations of an uncompressed bernese 
+    coordinate file.  The file is memory mapped, and on first access an 
+    index of the byte offset of each station record is built.  Only the 
+    records that are requested are parsed.  
+
+    Behaves as a dictionary of StationCoord objects keyed on station name 
+    (or code if useCode is True), as returned by read.  If velocityFilename
+    is specified then velocities are read lazily from that file. 
+    '''
+
+    _recordre=re.compile(br'^[ \d]{3}  ([^\r\n]{16})',re.M)
+
+    def __init__( self, filename, velocityFilename=None, useCode=False ):
+        filename=Util.expandpath(filename)
+        if Util.iscompressed(filename):
+            raise ValueError('Cannot lazily read compressed file '+filename)
+        import mmap
+        self.filename=filename
+        self.useCode=useCode
+        with open(filename,'rb') as f:
+            self._mmap=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        # The datum line is the third line of the file
+        pos=0
+        for i in range(2):
+            pos=self._mmap.find(b'\n',pos)+1
+        self._start=self._mmap.find(b'\n',pos)+1
+        dtm=_dtmfmt.read(self._mmap[pos:self._start].decode('latin-1'))
+        self.datum=dtm.datum
+        self.crddate=_parseEpoch(dtm.epoch,filename)
+        self._index=None
+        self._velocities=None
+        if velocityFilename is not None:
+            self._velocities=LazyCoordFile(velocityFilename,useCode=useCode)
+
+    def close( self ):
+        self._mmap.close()
+        if self._velocities is not None:
+            self._velocities.close()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.close()
+
+    def _getIndex( self ):
+        if self._index is None:
+            index={}
+            for match in self._recordre.finditer(self._mmap,self._start):
+                name=match.group(1).decode('latin-1').strip()
+                if name:
+                    index[name[:4] if self.useCode else name]=match.start()
+            self._index=index
+        return self._index
+
+    def _record( self, key ):
+        offset=self._getIndex()[key]
+        end=self._mmap.find(b'\n',offset)
+        if end < 0:
+            end=len(self._mmap)
+        return _crdfmt.read(self._mmap[offset:end].decode('latin-1'))
+
+    def __len__( self ):
+        return len(self._getIndex())
+
+    def __iter__( self ):
+        return iter(self._getIndex())
+
+    def __contains__( self, key ):
+        return key in self._getIndex()
+
+    def __getitem__( self, key ):
+        data=self._record(key)
+        vxyz=None
+        if self._velocities is not None and key in self._velocities:
+            vel=self._velocities._record(key)
+            vxyz=[vel.X,vel.Y,vel.Z]
+        return StationCoord(data.id,data.name[:4],data.name,self.datum,self.crddate,
+                            [data.X,data.Y,data.Z],vxyz,data.flag)
+
+    def stations( self, keys ):
+        '''
+        Returns a CoordSet of the stations with the specified keys
+        '''
+        coords=CoordSet.fromStations([self[k] for k in keys],useCode=self.useCode)
+        coords.datum=self.datum
+        coords.crddate=self.crddate
+        return coords
+
+@Instrument.instrumented('CoordFile.compare')
+def compare( codes=None, codesCoordFile=None, useCode=False, velocities=False, skipError=False, helmert=False, rejectFactor=None, rejectLimit=None, matchTolerance=None, **files ):
     '''
     Compare two or more bernese coordinate files, and return a pandas DataFrame of
     common codes. 
@@ -118,6 +676,21 @@ def compare( codes=None, codesCoordFile=None, useCode=False, velocities=False, s
     string [codes], or bernese coordinate file containing the codes [codesCoordFile]
 
     If just two files are compared then the differences are included in the data frame.
+    If helmert is True then a 7 parameter transformation from the first file 
+    to the second (in order of the keys, as for the differences) is 
+    calculated (see Helmert.estimate for rejectFactor and rejectLimit) and 
+    the differences after applying it are included as helmert_E, helmert_N,
+    helmert_U, and helmert_offset, with helmert_used flagging the stations 
+    used to calculate it.  The transformation 
+    parameters, RMS residual, and station count are saved in the DataFrame 
+    attrs as 'helmert'.
+
+    If matchTolerance is specified then stations are matched by proximity 
+    rather than by code.  Each station of the first file (in order of the 
+    keys) is matched to the nearest station of each other file within 
+    matchTolerance metres (see SpatialIndex.SpatialIndex.match).  The code 
+    column is the code in the first file, and the codes in each file are 
+    included as key_code.
     '''
     coords={}
     usecodes=None
@@ -126,7 +699,7 @@ def compare( codes=None, codesCoordFile=None, useCode=False, velocities=False, s
         nfiles += 1
         crddata=files[f]
         if isinstance(crddata,basestring): 
-            crddata=read(crddata,useCode=useCode,skipError=skipError,velocities=velocities)
+            crddata=read(crddata,useCode=useCode,skipError=skipError,velocities=velocities,coordSet=True)
         coords[f]=crddata
         fcodes=set(crddata)
         if usecodes is None:
@@ -136,81 +709,454 @@ def compare( codes=None, codesCoordFile=None, useCode=False, velocities=False, s
 
     if nfiles == 0:
         raise RuntimeError("No files specified in CoordFile.Compare")
+    keymap=None
+    if matchTolerance is not None:
+        usecodes, keymap = _matchStations(coords,matchTolerance,useCode)
     if usecodes is None or len(usecodes) == 0:
         raise RuntimeError("No common codes to compare in CoordFile.Compare")
 
-    codelist=None
     if codes is not None:
         if isinstance(codes,basestring):
             codes=codes.split()
         usecodes=usecodes.intersection(set(codes))
 
     if codesCoordFile is not None:
-        cfcodes=read(codesCoordFile,useCode=useCode,skipError=skipError)
+        cfcodes=read(codesCoordFile,useCode=useCode,skipError=skipError,coordSet=True)
         usecodes=usecodes.intersection(set(cfcodes))
 
     if len(usecodes) == 0:
         raise RuntimeError("No common codes selected in CoordFile.Compare")
+    if helmert and nfiles != 2:
+        raise RuntimeError("Helmert transformation requires two files in CoordFile.Compare")
 
-    data=[]
     usecodes=sorted(usecodes)
     crdtypes=sorted(coords)
     calcdiff=len(crdtypes) == 2
-    for code in sorted(usecodes):
-        codedata=[code]
-        cdata=[coords[t][code] for t in crdtypes]
-        lon,lat,hgt=GRS80.geodetic(cdata[0].xyz)
-        if lon < 0:
-            lon += 360.0
-        codedata.extend((lon,lat,hgt))
-        codedata.extend((c.flag for c in cdata))
-        for c in cdata:
-            codedata.extend(c.xyz)
-            if velocities:
-                codedata.extend(c.vxyz or [np.Nan,np.Nan,np.Nan])
-        if calcdiff:
-            xyz0=np.array(cdata[0].xyz)
-            xyz1=np.array(cdata[1].xyz)
-            dxyz=xyz1-xyz0
-            denu=GRS80.enu_axes(lon,lat).dot(dxyz)
-            codedata.extend(dxyz)
-            codedata.extend(denu)
-            codedata.append(la.norm(denu))
-            if velocities:
-                xyz0=np.array(cdata[0].vxyz or [np.NaN,np.NaN,np.NaN])
-                xyz1=np.array(cdata[1].vxyz or [np.NaN,np.NaN,np.NaN])
-                dxyz=xyz1-xyz0
-                denu=GRS80.enu_axes(lon,lat).dot(dxyz)
-                codedata.extend(dxyz)
-                codedata.extend(denu)
-                codedata.append(la.norm(denu))
-        data.append(codedata)
+    xyz={}
+    vxyz={}
+    flags={}
+    for t in crdtypes:
+        tcodes=usecodes if keymap is None else [keymap[t][c] for c in usecodes]
+        xyz[t],vxyz[t],flags[t]=_coordArrays(coords[t],tcodes)
+
+    lon,lat,hgt=_geodetic(xyz[crdtypes[0]])
 
+    data={'code': usecodes, 'lon': lon, 'lat': lat, 'hgt': hgt}
     columns=['code','lon','lat','hgt']
-    columns.extend((t+'_flg' for t in crdtypes))
-    for  t in crdtypes:
-        columns.extend((t+'_X',t+'_Y',t+'_Z'))
+    if keymap is not None:
+        for t in crdtypes:
+            data[t+'_code']=[keymap[t][c] for c in usecodes]
+            columns.append(t+'_code')
+    for t in crdtypes:
+        data[t+'_flg']=flags[t]
+        columns.append(t+'_flg')
+    for t in crdtypes:
+        _addColumns(data,columns,(t+'_X',t+'_Y',t+'_Z'),xyz[t])
         if velocities:
-            columns.extend((t+'_VX',t+'_VY',t+'_VZ'))
+            _addColumns(data,columns,(t+'_VX',t+'_VY',t+'_VZ'),vxyz[t])
     if calcdiff:
-        columns.extend(('diff_X','diff_Y','diff_Z','diff_E','diff_N','diff_U','offset'))
+        enu_axes=_enuAxes(lon,lat)
+        dxyz=xyz[crdtypes[1]]-xyz[crdtypes[0]]
+        denu=np.einsum('nij,nj->ni',enu_axes,dxyz)
+        _addColumns(data,columns,('diff_X','diff_Y','diff_Z'),dxyz)
+        _addColumns(data,columns,('diff_E','diff_N','diff_U'),denu)
+        data['offset']=np.sqrt(np.sum(denu*denu,axis=1))
+        columns.append('offset')
+        if helmert:
+            fit=Helmert.estimate(xyz[crdtypes[0]],xyz[crdtypes[1]],
+                                 rejectFactor=rejectFactor,rejectLimit=rejectLimit)
+            henu=np.einsum('nij,nj->ni',enu_axes,fit.residuals)
+            _addColumns(data,columns,('helmert_E','helmert_N','helmert_U'),henu)
+            data['helmert_offset']=np.sqrt(np.sum(henu*henu,axis=1))
+            data['helmert_used']=fit.used
+            columns.extend(('helmert_offset','helmert_used'))
         if velocities:
-            columns.extend(('diff_VX','diff_VY','diff_VZ','diff_VE','diff_VN','diff_VU','offsetV'))
-    df=pd.DataFrame(data,columns=columns)
-    df.set_index(df.code,inplace=True)
+            dxyz=vxyz[crdtypes[1]]-vxyz[crdtypes[0]]
+            denu=np.einsum('nij,nj->ni',enu_axes,dxyz)
+            _addColumns(data,columns,('diff_VX','diff_VY','diff_VZ'),dxyz)
+            _addColumns(data,columns,('diff_VE','diff_VN','diff_VU'),denu)
+            data['offsetV']=np.sqrt(np.sum(denu*denu,axis=1))
+            columns.append('offsetV')
+
+    with Instrument.stage('dataframe'):
+        import pandas as pd
+        df=pd.DataFrame(data,columns=columns)
+        df.set_index(df.code,inplace=True)
+    if calcdiff and helmert:
+        params=dict(zip(Helmert.parameters,fit.params.tolist()))
+        params.update(rms=float(fit.rms),count=int(fit.count))
+        df.attrs['helmert']=params
     return df
 
 
+def _matchStations( coords, tolerance, useCode ):
+    # Match the stations of a dictionary of coordinate data by proximity to
+    # those of the first key.  Returns the set of matched codes of the first
+    # key, and a dictionary for each key mapping these to the matching codes.
+    crdtypes=sorted(coords)
+    for t in crdtypes:
+        coords[t]=CoordSet.fromStations(coords[t],useCode=useCode)
+    refset=coords[crdtypes[0]]
+    refkeys=list(refset)
+    index=refset.spatialIndex()
+    usecodes=set(refkeys)
+    keymap={crdtypes[0]: dict(zip(refkeys,refkeys))}
+    for t in crdtypes[1:]:
+        rows=index.match(coords[t].xyz,tolerance)
+        keymap[t]=dict((refkeys[r],k) for r,k in zip(rows.tolist(),list(coords[t])) if r >= 0)
+        usecodes.intersection_update(keymap[t])
+    return usecodes, keymap
+
+def _stackSolutions( coordsets, codes ):
+    '''
+    Stack the coordinates of a list of CoordSets for a list of codes into an
+    array of shape (nsol,nsta,3), NaN where a solution does not include a 
+    station.
+    '''
+    xyz=np.full((len(coordsets),len(codes),3),np.nan)
+    for i, crd in enumerate(coordsets):
+        rows=crd.rows(codes)
+        found=rows >= 0
+        xyz[i,found]=crd.xyz[rows[found]]
+    return xyz
+
+def _nanStats( values, axis ):
+    '''
+    Returns the count, mean, standard deviation, and RMS of the finite 
+    values along an axis, NaN where there are no values.
+    '''
+    finite=np.isfinite(values)
+    count=np.sum(finite,axis=axis)
+    values=np.where(finite,values,0.0)
+    ncount=np.maximum(count,1)
+    mean=np.sum(values,axis=axis)/ncount
+    meansq=np.sum(values*values,axis=axis)/ncount
+    std=np.sqrt(np.maximum(meansq-mean*mean,0.0))
+    rms=np.sqrt(meansq)
+    for v in (mean,std,rms):
+        v[count == 0]=np.nan
+    return count, mean, std, rms
+
+class CoordComparison( object ):
+    '''
+    N-way comparison of coordinate solutions, as returned by compare_many.
+    Solutions are stacked over the union of stations in all solutions. 
+    Attributes are:
+
+       names      the names of the solutions
+       codes      the station codes (or names)
+       xyz        array (nsol,nsta,3) of coordinates, NaN where a solution 
+                  does not include a station
+       reference  the name of the reference solution ('mean' for the mean
+                  of the solutions)
+       refxyz     array (nsta,3) of reference coordinates
+       lon,lat,hgt  the geodetic coordinates of the mean station positions
+       dxyz,denu  arrays (nsol,nsta,3) of differences from the reference
+       helmert    array (nsol,7) of Helmert parameters (see Helmert) if
+                  the solutions were aligned, otherwise None
+       helmertUsed  array (nsol,nsta) of the stations used in the Helmert
+                  transformations, or None
+       aligned    array (nsol,nsta,3) of ENU differences after removing the
+                  Helmert transformation, or None
+    '''
+
+    def __init__( self, names, codes, coordsets, reference=None, helmert=False, rejectFactor=None, rejectLimit=None ):
+        self.names=list(names)
+        self.codes=list(codes)
+        self.xyz=_stackSolutions(coordsets,self.codes)
+        count, meanxyz, std, rms = _nanStats(self.xyz,0)
+        if reference is None or reference == 'mean':
+            self.reference='mean'
+            self.refxyz=meanxyz
+        elif reference in self.names:
+            self.reference=reference
+            self.refxyz=self.xyz[self.names.index(reference)]
+        else:
+            raise ValueError('Invalid reference solution '+str(reference)+' in CoordFile.compare_many')
+
+        self.lon,self.lat,self.hgt=_geodetic(meanxyz)
+        self._enu=_enuAxes(self.lon,self.lat)
+        self.dxyz=self.xyz-self.refxyz
+        self.denu=self._toEnu(self.dxyz)
+        self.helmert=None
+        self.helmertUsed=None
+        self.aligned=None
+        if helmert:
+            fit=Helmert.estimate(self.refxyz,self.xyz,rejectFactor=rejectFactor,rejectLimit=rejectLimit)
+            self.helmert=fit.params
+            self.helmertUsed=fit.used
+            self.aligned=self._toEnu(fit.residuals)
+
+    def _toEnu( self, dxyz ):
+        return np.einsum('kij,skj->ski',self._enu,dxyz)
+
+    def _differences( self, aligned ):
+        if not aligned:
+            return self.denu
+        if self.aligned is None:
+            raise ValueError('Comparison was not calculated with helmert=True')
+        return self.aligned
+
+    def stationSummary( self, aligned=False ):
+        '''
+        Returns a pandas DataFrame indexed by code of the number of solutions
+        including each station, and the mean, standard deviation (scatter), 
+        and RMS of the ENU differences from the reference.  If aligned is 
+        True then the differences after Helmert alignment are used.
+        '''
+        import pandas as pd
+        count, mean, std, rms = _nanStats(self._differences(aligned),0)
+        data={'code': self.codes, 'lon': self.lon, 'lat': self.lat, 'hgt': self.hgt, 'count': count[:,0]}
+        columns=['code','lon','lat','hgt','count']
+        for stat, values in (('mean',mean),('std',std),('rms',rms)):
+            _addColumns(data,columns,[stat+'_'+c for c in 'ENU'],values)
+        df=pd.DataFrame(data,columns=columns)
+        df.set_index(df.code,inplace=True)
+        return df
+
+    def solutionSummary( self, aligned=False ):
+        '''
+        Returns a pandas DataFrame indexed by solution name of the number of
+        stations compared with the reference, the RMS ENU differences, and 
+        the maximum offset.  Includes the Helmert parameters if the 
+        solutions were aligned.
+        '''
+        import pandas as pd
+        denu=self._differences(aligned)
+        count, mean, std, rms = _nanStats(denu,1)
+        offset=np.sqrt(np.sum(denu*denu,axis=2))
+        offset=np.where(np.isfinite(offset),offset,-1.0).max(axis=1) if len(self.codes) else np.full((len(self.names),),-1.0)
+        offset[offset < 0]=np.nan
+        data={'solution': self.names, 'count': count[:,0], 'maxoffset': offset}
+        columns=['solution','count']
+        _addColumns(data,columns,['rms_E','rms_N','rms_U'],rms)
+        columns.append('maxoffset')
+        if self.helmert is not None:
+            data['helmert_count']=np.sum(self.helmertUsed,axis=1)
+            columns.append('helmert_count')
+            _addColumns(data,columns,Helmert.parameters,self.helmert)
+        df=pd.DataFrame(data,columns=columns)
+        df.set_index(df.solution,inplace=True)
+        return df
+
+    def differences( self, aligned=False ):
+        '''
+        Returns a long format pandas DataFrame with columns solution, code,
+        diff_E, diff_N, diff_U for each station in each solution that can 
+        be compared with the reference.
+        '''
+        import pandas as pd
+        denu=self._differences(aligned)
+        isol,ista=np.nonzero(np.all(np.isfinite(denu),axis=2))
+        data={
+            'solution': np.array(self.names,dtype=object)[isol],
+            'code': np.array(self.codes,dtype=object)[ista],
+            }
+        columns=['solution','code']
+        _addColumns(data,columns,('diff_E','diff_N','diff_U'),denu[isol,ista])
+        return pd.DataFrame(data,columns=columns)
+
+@Instrument.instrumented('CoordFile.compare_many')
+def compare_many( files, reference=None, codes=None, codesCoordFile=None, useCode=False, skipError=False, helmert=False, rejectFactor=None, rejectLimit=None, workers=None ):
+    '''
+    Compare any number of bernese coordinate solutions, returning a 
+    CoordComparison.  files is either a list of file names or coordinate 
+    data (CoordSet or dictionaries as returned by read), or a dictionary of
+    these keyed on the solution name.  Solutions from a list are named by
+    file name (crd1, crd2, ... for coordinate data). 
+
+    The differences are calculated relative to the named reference solution
+    or to the mean of the solutions if reference is None.  If helmert is 
+    True then a 7 parameter transformation to each solution from the 
+    reference is also calculated, and the residuals after removing it 
+    are available.  rejectFactor and rejectLimit control the rejection of
+    outliers from the transformation (see Helmert.estimate).
+
+    Can take a list of codes to include in the comparison as either a list or
+    string [codes], or bernese coordinate file containing the codes 
+    [codesCoordFile].  Files are read in parallel processes if workers is 
+    greater than 1 (see read_many).
+    '''
+    if isinstance(files,dict):
+        names=sorted(files)
+        sources=[files[n] for n in names]
+    else:
+        sources=list(files)
+        names=[os.path.basename(f) if isinstance(f,basestring) else 'crd'+str(i+1)
+               for i,f in enumerate(sources)]
+        if len(set(names)) < len(names):
+            names=[f if isinstance(f,basestring) else n for f,n in zip(sources,names)]
+    if len(sources) == 0:
+        raise RuntimeError("No files specified in CoordFile.compare_many")
+
+    filenames=[f for f in sources if isinstance(f,basestring)]
+    loaded=iter(read_many(filenames,workers=workers,useCode=useCode,skipError=skipError))
+    coordsets=[]
+    for f in sources:
+        if isinstance(f,basestring):
+            f=next(loaded)
+        elif not isinstance(f,CoordSet):
+            f=CoordSet.fromStations(f.values(),useCode=useCode)
+        coordsets.append(f)
+
+    usecodes=set()
+    for crd in coordsets:
+        usecodes.update(crd)
+    if codes is not None:
+        if isinstance(codes,basestring):
+            codes=codes.split()
+        usecodes=usecodes.intersection(set(codes))
+    if codesCoordFile is not None:
+        cfcodes=read(codesCoordFile,useCode=useCode,skipError=skipError,coordSet=True)
+        usecodes=usecodes.intersection(set(cfcodes))
+    if len(usecodes) == 0:
+        raise RuntimeError("No codes selected in CoordFile.compare_many")
+
+    return CoordComparison(names,sorted(usecodes),coordsets,reference=reference,
+                           helmert=helmert,rejectFactor=rejectFactor,rejectLimit=rejectLimit)
+
+
+def readManifest( filename ):
+    '''
+    Read a manifest of coordinate file comparisons for compare_batch.  Each
+    line of the manifest has the two files to compare and optionally a name
+    for the comparison (default the line number), separated by spaces or 
+    commas.  Blank lines and lines starting with # are ignored.  Returns a 
+    list of (name, file1, file2).
+    '''
+    comparisons=[]
+    with open(Util.expandpath(filename)) as f:
+        for lineno, line in enumerate(f):
+            line=line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts=re.split(r'[\s,]+',line)
+            if len(parts) not in (2,3):
+                raise RuntimeError('Invalid comparison at line '+str(lineno+1)+' of '+filename)
+            name=parts[2] if len(parts) == 3 else str(lineno+1)
+            comparisons.append((name,parts[0],parts[1]))
+    return comparisons
+
+def _compareItem( comparison, **options ):
+    # Run one comparison of compare_batch.  Errors are returned rather than
+    # raised so that one failure does not stop a worker pool.
+    name, file1, file2 = comparison
+    try:
+        df=compare(crd1=file1,crd2=file2,**options)
+    except Exception as ex:
+        return name, None, str(ex)
+    df.insert(0,'file2',file2)
+    df.insert(0,'file1',file1)
+    df.insert(0,'comparison',name)
+    return name, df, None
+
+def compare_batch( comparisons, workers=None, **options ):
+    '''
+    Run many comparisons of pairs of coordinate files, such as read by
+    readManifest.  comparisons is a list of (name, file1, file2).  Each
+    comparison is run with compare (with the files keyed crd1 and crd2 and 
+    the other options passed to it).  If workers is greater than 1 the 
+    comparisons are run in a pool of that many processes (0 for one per 
+    CPU).  Returns an iterator of (name, DataFrame, error) in the order of 
+    the comparisons, where the DataFrame has additional columns comparison,
+    file1 and file2, or is None and error is the error message if the 
+    comparison failed.
+    '''
+    comparisons=list(comparisons)
+    if workers is None or workers == 1 or len(comparisons) < 2:
+        with Util.prefetch([f for c in comparisons for f in c[1:]]):
+            for c in comparisons:
+                yield _compareItem(c,**options)
+        return
+    import functools
+    from concurrent.futures import ProcessPoolExecutor
+    workers=workers or os.cpu_count() or 1
+    chunksize=max(1,len(comparisons)//(workers*4))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for result in pool.map(functools.partial(_compareItem,**options),comparisons,chunksize=chunksize):
+            yield result
+
+class _BatchOutput( object ):
+    # Writes the DataFrames of compare_batch to a single CSV file (or stdout
+    # if the filename is None or -) or Parquet file (.parquet extension) as 
+    # they are calculated
+
+    def __init__( self, filename ):
+        self._filename=filename
+        self._parquet=filename is not None and filename.lower().endswith('.parquet')
+        self._file=None
+        self._writer=None
+
+    def write( self, df ):
+        if self._parquet:
+            import pyarrow
+            import pyarrow.parquet
+            if self._writer is None:
+                table=pyarrow.Table.from_pandas(df,preserve_index=False)
+                self._writer=pyarrow.parquet.ParquetWriter(self._filename,table.schema)
+            else:
+                table=pyarrow.Table.from_pandas(df,schema=self._writer.schema,preserve_index=False)
+            self._writer.write_table(table)
+            return
+        header=self._file is None
+        if header:
+            if self._filename is None or self._filename == '-':
+                self._file=sys.stdout
+            else:
+                self._file=open(self._filename,'w')
+        df.to_csv(self._file,index=False,header=header,float_format="%.6f")
+
+    def close( self ):
+        if self._writer is not None:
+            self._writer.close()
+        if self._file is not None and self._file is not sys.stdout:
+            self._file.close()
+
+def _batch_main( args ):
+    if args.crd_file_1 is not None or args.crd_file_2 is not None:
+        raise RuntimeError('Cannot specify CRD files with --batch')
+    comparisons=readManifest(args.batch)
+    output=_BatchOutput(args.output)
+    nfailed=0
+    try:
+        for name, df, error in compare_batch(comparisons,workers=args.workers,useCode=args.use_code,
+                                             skipError=True,velocities=args.use_velocities,
+                                             helmert=args.helmert,rejectFactor=args.reject_factor,
+                                             rejectLimit=args.reject_limit,matchTolerance=args.match_tolerance):
+            if error is not None:
+                nfailed += 1
+                sys.stderr.write('Comparison '+name+' failed: '+error+'\n')
+            else:
+                output.write(df)
+    finally:
+        output.close()
+    if nfailed:
+        sys.stderr.write('{0} of {1} comparisons failed\n'.format(nfailed,len(comparisons)))
+        sys.exit(1)
+
 def compare_main():
     import argparse
-    parser=argparse.ArgumentParser(description='Compare two bernese coordinate files')
-    parser.add_argument('crd_file_1',help='Name of first CRD file (can enter as type=filename)')
-    parser.add_argument('crd_file_2',help='Name of second CRD file (can enter as type=filename)')
+    parser=argparse.ArgumentParser(description='Compare two bernese coordinate files, or many pairs of files listed in a manifest file')
+    parser.add_argument('crd_file_1',nargs='?',help='Name of first CRD file (can enter as type=filename)')
+    parser.add_argument('crd_file_2',nargs='?',help='Name of second CRD file (can enter as type=filename)')
     parser.add_argument('csv_file',nargs='?',help='Name of output CSV file of differences')
     parser.add_argument('-c','--use-code',action='store_true',help='Use station code rather than full name')
     parser.add_argument('-v','--use-velocities',action='store_true',help='Compare velocities as well as ')
+    parser.add_argument('-t','--helmert',action='store_true',help='Calculate differences after removing a 7 parameter Helmert transformation')
+    parser.add_argument('-r','--reject-factor',type=float,help='Reject stations with Helmert residuals greater than this times the RMS residual')
+    parser.add_argument('-l','--reject-limit',type=float,help='Reject stations with Helmert residuals greater than this (metres)')
+    parser.add_argument('-m','--match-tolerance',type=float,help='Match stations by proximity within this distance (metres) rather than by code')
+    parser.add_argument('-b','--batch',help='Manifest file of comparisons, each line listing two CRD files and optionally a name')
+    parser.add_argument('-o','--output',help='Output file for --batch - CSV, or Parquet if it ends with .parquet (default CSV to standard output)')
+    parser.add_argument('-w','--workers',type=int,help='Number of worker processes for --batch (0 for one per CPU)')
     args=parser.parse_args()
 
+    if args.batch:
+        _batch_main(args)
+        return
+    if args.crd_file_2 is None:
+        parser.error('Two CRD files or a --batch manifest are required')
+
     cmpfiles={}
     for i,f in enumerate((args.crd_file_1,args.crd_file_2)):
         if '=' in f:
@@ -219,11 +1165,20 @@ def compare_main():
         else:
             cmpfiles['crd'+str(i+1)]=f
 
-    cmpdata=compare(useCode=args.use_code,skipError=True,velocities=args.use_velocities,**cmpfiles)
+    cmpdata=compare(useCode=args.use_code,skipError=True,velocities=args.use_velocities,
+                    helmert=args.helmert,rejectFactor=args.reject_factor,rejectLimit=args.reject_limit,
+                    matchTolerance=args.match_tolerance,**cmpfiles)
     if args.csv_file is not None:
         cmpdata.to_csv(args.csv_file,index=False,float_format="%.6f")
     else:
         print(cmpdata.loc[:,('diff_X','diff_Y','diff_Z','diff_E','diff_N','diff_U')].describe());
+    if args.helmert:
+        params=cmpdata.attrs['helmert']
+        print('Helmert transformation (translations m, rotations micro-radians, scale ppm)')
+        for p in Helmert.parameters+('rms','count'):
+            print('  {0:8s} {1:12.6f}'.format(p,params[p]))
+        if args.csv_file is None:
+            print(cmpdata.loc[cmpdata.helmert_used,('helmert_E','helmert_N','helmert_U')].describe());
 
 if __name__=='__main__':
     compare_main()
@@ -1,13 +1,38 @@
 from collections import namedtuple
 from . import Util
+from . import Cache
+from . import Instrument
 from .Fortran import Format
 
 Station=namedtuple('Station','code name')
 
+_stnfmt=Format('A16','name',True)
+
+def _readFixArrays( filename ):
+    return {'data': _stnfmt.readfilearray(filename,skipLines=5,skipBlanks=True)}
+
+@Instrument.instrumented('FixFile.read')
 def read( f ):
-    stns=[]
-    stnfmt=Format('A16','name',True)
-    for data in stnfmt.readfile(Util.expandpath(f),skipLines=5,skipBlanks=True):
-        stns.append(Station(data.name[:4],data.name))
-    return stns
+    data=Cache.cached('FIX',Util.expandpath(f),_readFixArrays)['data']
+    return [Station(name[:4],name) for name in data['name'].tolist()]
+
+def write( f, stations, title=None, created=None ):
+    '''
+    Write a station (fix) file.  stations is a list of Station objects (as
+    returned by read) or station names.  title is written at the top of the 
+    file with the created date (default now).
+    '''
+    names=[getattr(s,'name',s) for s in stations]
+    with Util.openoutput(Util.expandpath(f)) as sf:
+        header=Util.headerlines(title,created)
+        header.extend(('','STATION NAME','****************'))
+        sf.write('\n'.join(header)+'\n')
+        _stnfmt.writearray(sf,(names,))
 
+def read_many( filenames, workers=None ):
+    '''
+    Read a list of files, returning a list of the results in the same order
+    as the files.  If workers is greater than 1 the files are parsed in a 
+    pool of that many processes (0 for one per CPU).
+    '''
+    return Util.mapfiles(read,filenames,workers=workers)
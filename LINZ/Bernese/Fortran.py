@@ -1,10 +1,18 @@
 import re
 from collections import namedtuple
+import numpy as np
+
+from . import Util
+from . import Instrument
 
 class Format( object ):
     '''
     Class for reading fortran formatted data using a fortran format specification
     to define fixed length fields.  
+
+    The format is compiled once into a list of slices and converters, so 
+    parsing a record is a single pass over the slices.  Whole files can be 
+    parsed in bulk into a numpy structured array using readarray.
     '''
 
     def __init__( self, format, names=None, trim=False ):
@@ -43,42 +51,107 @@ class Format( object ):
         fields = []
         ffloat = lambda x: float(x.replace('D','E'))
         fstr = (lambda x: str(x).strip()) if trim else str
-        for m in re.findall('(\d*)(X|[FIAH](\d*))',format):
+        for m in re.findall(r'(\d*)(X|[FIAH](\d*)(?:\.(\d+))?)',format):
             fields.append((
                 int(m[0] or 1),
                 int(m[2] or 1),
                 int if m[1][0]=='I' else
                 ffloat if m[1][0]=='F' else
                 fstr if m[1][0] in 'AH' else
-                None
+                None,
+                m[1][0].replace('H','A'),
+                int(m[3] or 0)
             ))
-        self._fields = fields
+        self._fields = [f[:3] for f in fields]
         self._length = sum( (f[0]*f[1] for f in fields) )
         self._fieldcount = sum( f[0] for f in fields if f[2])
+        self._trim = trim
+
+        # Compile the fields into slices and converters for each value
+        parsers=[]
+        columns=[]
+        template=[]
+        pos=0
+        for count, width, ftype, code, decimals in fields:
+            for c in range(count):
+                if ftype:
+                    parsers.append((slice(pos,pos+width),ftype))
+                    columns.append((pos,width,code))
+                    template.append(
+                        '%{0}d'.format(width) if code == 'I' else
+                        '%{0}.{1}f'.format(width,decimals) if code == 'F' else
+                        '%-{0}.{0}s'.format(width))
+                else:
+                    template.append(' '*width)
+                pos += width
+        self._parsers = parsers
+        self._columns = columns
+        self._template = ''.join(template)
+
         if names:
             fieldnames=names.split()
             if len(fieldnames) != self._fieldcount:
                 raise ValueError('Number of field names in "'+names+'" doesn\'t match format "'+self._format+'"')
             rectype=namedtuple('record',fieldnames)
-            self._rectype=lambda x: rectype(*x)
+            self._rectype=rectype._make
         else:
+            fieldnames=['f'+str(i) for i in range(self._fieldcount)]
             self._rectype=tuple
+        self._names = fieldnames
+
+        dtypes={'I': lambda w: 'i8', 'F': lambda w: 'f8', 'A': lambda w: 'U'+str(w)}
+        self.dtype = np.dtype([(str(n),dtypes[c[2]](c[1])) for n,c in zip(fieldnames,columns)])
+        self._rawdtype = np.dtype({
+            'names': [str(n) for n in fieldnames],
+            'formats': ['S'+str(c[1]) for c in columns],
+            'offsets': [c[0] for c in columns],
+            'itemsize': max(self._length,1),
+            })
 
     def read( self, data ):
         '''
         Parse a string using the format
         '''
-        values = []
-        pos = 0
         if len(data) < self._length:
             data = data + ' '*(self._length)
-        for count, width, ftype in self._fields:
-            for c in range(count):
-                s = data[pos:pos+width]
-                pos += width
-                if ftype:
-                    values.append(ftype(s))
-        return self._rectype(values)
+        return self._rectype([ftype(data[s]) for s, ftype in self._parsers])
+
+    def format( self, values, rstrip=True ):
+        '''
+        Format a record (a sequence of values for the fields) as a string
+        using the format.  If rstrip is True then trailing blanks are removed.
+        '''
+        result=self._template % tuple(values)
+        return result.rstrip() if rstrip else result
+
+    def formatarray( self, data, rstrip=True ):
+        '''
+        Format a set of records as a list of strings.  data can be a numpy
+        structured array or dictionary of columns with the names of the 
+        format fields, or a sequence of columns in the order of the fields. 
+        If rstrip is True then trailing blanks are removed.
+        '''
+        if isinstance(data,np.ndarray) and data.dtype.names:
+            columns=[data[n] for n in self._names]
+        elif isinstance(data,dict):
+            columns=[data[n] for n in self._names]
+        else:
+            columns=list(data)
+        if len(columns) != self._fieldcount:
+            raise ValueError('Number of columns doesn\'t match format "'+self._format+'"')
+        columns=[c.tolist() if isinstance(c,np.ndarray) else c for c in columns]
+        template=self._template
+        if rstrip:
+            return [(template % r).rstrip() for r in zip(*columns)]
+        return [template % r for r in zip(*columns)]
+
+    def writearray( self, stream, data, rstrip=True ):
+        '''
+        Write a set of records (see formatarray) to a stream in a single write
+        '''
+        lines=self.formatarray(data,rstrip=rstrip)
+        if lines:
+            stream.write('\n'.join(lines)+'\n')
 
     def readiter( self, stream, skipErrors=False, skipBlanks=False ):
         '''
@@ -97,6 +170,85 @@ class Format( object ):
                 if not skipErrors:
                     raise
 
+    def readarray( self, stream, skipErrors=False, skipBlanks=False ):
+        '''
+        Parse all the records from a stream (or list of lines) into a numpy 
+        structured array with fields named as for the format (f0, f1, ...
+        if no names were supplied).  I fields are int64, F fields are float64,
+        and A fields are unicode strings.
+
+        stream - the stream to read
+        skipErrors - if True then records not matching the format are skipped
+        skipBlanks - if True then blank records are skipped
+        '''
+        with Instrument.stage('io'):
+            lines=list(stream)
+        with Instrument.stage('parse'):
+            result=self._parselines(lines,skipErrors,skipBlanks)
+        Instrument.count(records=len(result))
+        return result
+
+    def _parselines( self, lines, skipErrors, skipBlanks ):
+        if lines and isinstance(lines[0],bytes):
+            lines=[l.decode('latin-1') for l in lines]
+        if skipBlanks:
+            lines=[l for l in lines if l.strip() != '']
+        length=self._rawdtype.itemsize
+        text=''.join([l.rstrip('\r\n').ljust(length)[:length] for l in lines])
+        buffer=bytearray(text.encode('latin-1','replace'))
+        rows=np.frombuffer(buffer,dtype=np.uint8).reshape((len(lines),length))
+        for pos, width, code in self._columns:
+            if code == 'F':
+                # Convert fortran double precision exponents
+                fbytes=rows[:,pos:pos+width]
+                fbytes[fbytes==ord('D')]=ord('E')
+        raw=rows.reshape(-1).view(self._rawdtype)
+        values={}
+        valid=None
+        for name, column in zip(self._names,self._columns):
+            if column[2] == 'A':
+                continue
+            ctype=self.dtype[name]
+            try:
+                values[name]=raw[name].astype(ctype)
+            except ValueError:
+                if not skipErrors:
+                    raise
+                convert=int if column[2] == 'I' else float
+                ok=np.array([self._isValid(v,convert) for v in raw[name].tolist()],dtype=bool)
+                valid=ok if valid is None else valid & ok
+        if valid is not None:
+            Instrument.count(skipped=int(np.sum(~valid)))
+            raw=raw[valid]
+            values={}
+        result=np.empty(raw.shape,dtype=self.dtype)
+        for name, column in zip(self._names,self._columns):
+            if name in values:
+                result[name]=values[name]
+                continue
+            value=raw[name]
+            if column[2] == 'A':
+                if self._trim:
+                    value=np.char.strip(value)
+                try:
+                    value=value.astype(self.dtype[name])
+                except UnicodeDecodeError:
+                    value=np.char.decode(value,'latin-1')
+            else:
+                value=value.astype(self.dtype[name])
+            result[name]=value
+        return result
+
+    def _isValid( self, value, convert ):
+        try:
+            convert(value)
+        except ValueError:
+            return False
+        return True
+
+    def _open( self, filename ):
+        return Util.openfile(filename)
+
     def readfile( self, filename, skipErrors=False, skipLines=0, skipBlanks=False ):
         '''
         Iterator returning parsed data from a file
@@ -108,11 +260,7 @@ class Format( object ):
         '''
         f=None
         try:
-            if filename.endswith('.gz'):
-                import gzip
-                f=gzip.open(filename,'rb')
-            else:
-                f=open(filename)
+            f=self._open(filename)
             for i in range(skipLines):
                 f.readline()
             for r in self.readiter(f,skipErrors=skipErrors,skipBlanks=skipBlanks):
@@ -121,3 +269,16 @@ class Format( object ):
             if f is not None:
                 f.close()
 
+    def readfilearray( self, filename, skipErrors=False, skipLines=0, skipBlanks=False ):
+        '''
+        Read a file into a numpy structured array (see readarray)
+
+        filename - the name of the file to read
+        skipLine - the number of lines at the beginning of the file to skip over
+        skipErrors - if True then records not matching the format are skipped
+        skipBlanks - if True then blank records are skipped
+        '''
+        with self._open(filename) as f:
+            for i in range(skipLines):
+                f.readline()
+            return self.readarray(f,skipErrors=skipErrors,skipBlanks=skipBlanks)
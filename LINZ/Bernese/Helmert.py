@@ -0,0 +1,131 @@
+'''
+Vectorized 7 parameter Helmert transformation estimation.
+
+The transformation parameters are tx, ty, tz (translations in metres),
+rx, ry, rz (small position vector rotations in micro-radians), and scale
+(ppm), so that
+
+   xyz' = xyz + t + (scale*xyz + r x xyz)*1.0e-6
+
+Estimation is batched - the transformations from a set of reference
+coordinates to any number of solutions are calculated in one set of array
+operations.  Stations missing from a solution are represented by NaN
+coordinates.
+'''
+
+from collections import namedtuple
+import numpy as np
+
+parameters=('tx','ty','tz','rx','ry','rz','scale')
+
+HelmertFit=namedtuple('HelmertFit','params used offsets residuals rms count iterations')
+HelmertFit.__doc__='''
+Result of a Helmert transformation estimation.  For nsol solutions and
+nsta stations:
+
+   params     (nsol,7) transformation parameters, NaN if fewer than three
+              stations were used
+   used       (nsol,nsta) boolean array of stations used in the fit
+   offsets    (nsol,nsta,3) coordinate offsets due to the transformation
+   residuals  (nsol,nsta,3) differences remaining after the transformation
+   rms        (nsol,) RMS of the residual vectors of the stations used
+   count      (nsol,) number of stations used
+   iterations number of outlier rejection iterations
+'''
+
+def _design( refxyz, centre ):
+    # Design matrix (nsta,3,7) in megametres relative to centre for
+    # numerical stability
+    valid=np.all(np.isfinite(refxyz),axis=1)
+    x,y,z=(np.where(valid[:,None],refxyz-centre,0.0)/1.0e6).T
+    zero=np.zeros(x.shape)
+    one=np.ones(x.shape)
+    return np.array([
+        [one,zero,zero,zero,z,-y,x],
+        [zero,one,zero,-z,zero,x,y],
+        [zero,zero,one,y,-x,zero,z],
+        ]).transpose((2,0,1))
+
+def _solve( design, dxyz, used ):
+    weight=used.astype(np.float64)
+    normal=np.einsum('sk,kmi,kmj->sij',weight,design,design,optimize=True)
+    rhs=np.einsum('sk,kmi,skm->si',weight,design,np.where(used[:,:,None],dxyz,0.0),optimize=True)
+    params=np.einsum('sij,sj->si',np.linalg.pinv(normal),rhs)
+    params[np.sum(used,axis=1) < 3]=np.nan
+    return params
+
+def estimate( refxyz, xyz, rejectFactor=None, rejectLimit=None, maxIterations=10, used=None ):
+    '''
+    Estimate the Helmert transformations from reference coordinates refxyz
+    (nsta,3) to one (nsta,3) or more (nsol,nsta,3) solutions by least
+    squares using the stations defined in both.  Returns a HelmertFit, with
+    the solution axis omitted if xyz is a single solution.
+
+    Outliers are rejected iteratively if rejectFactor or rejectLimit is
+    defined.  At each iteration stations with a residual vector longer than
+    rejectFactor times the RMS residual of the solution, or rejectLimit
+    metres, are excluded and the transformation recalculated, until the
+    set of stations used does not change or maxIterations is reached.  used
+    is an optional boolean array of stations that may be used in the fit.
+    '''
+    refxyz=np.asarray(refxyz,dtype=np.float64)
+    xyz=np.asarray(xyz,dtype=np.float64)
+    single=xyz.ndim == 2
+    if single:
+        xyz=xyz[None]
+    dxyz=xyz-refxyz
+    valid=np.all(np.isfinite(dxyz),axis=2)
+    if used is not None:
+        valid &= np.asarray(used,dtype=bool).reshape((-1,)+valid.shape[1:])
+    reffinite=np.all(np.isfinite(refxyz),axis=1)
+    centre=refxyz[reffinite].mean(axis=0) if np.any(reffinite) else np.zeros((3,))
+    design=_design(refxyz,centre)
+
+    used=valid
+    iterations=0
+    while True:
+        params=_solve(design,dxyz,used)
+        offsets=np.einsum('kmi,si->skm',design,params)
+        residuals=dxyz-offsets
+        dist=np.sqrt(np.sum(np.where(valid[:,:,None],residuals,0.0)**2,axis=2))
+        count=np.sum(used,axis=1)
+        rms=np.sqrt(np.sum(np.where(used,dist*dist,0.0),axis=1)/np.maximum(count,1))
+        if (rejectFactor is None and rejectLimit is None) or iterations >= maxIterations:
+            break
+        limit=np.full(rms.shape,np.inf)
+        if rejectFactor is not None:
+            limit=np.minimum(limit,rejectFactor*rms)
+        if rejectLimit is not None:
+            limit=np.minimum(limit,rejectLimit)
+        # Stations rejected in earlier iterations are restored if they fit
+        # the revised transformation
+        keep=valid & (dist <= limit[:,None])
+        if np.array_equal(keep,used):
+            break
+        used=keep
+        iterations += 1
+    rms[count < 3]=np.nan
+
+    # Express the translations relative to the geocentre
+    c=centre/1.0e6
+    rx,ry,rz,scale=params[:,3],params[:,4],params[:,5],params[:,6]
+    params[:,0] -= scale*c[0]+ry*c[2]-rz*c[1]
+    params[:,1] -= scale*c[1]+rz*c[0]-rx*c[2]
+    params[:,2] -= scale*c[2]+rx*c[1]-ry*c[0]
+
+    if single:
+        return HelmertFit(params[0],used[0],offsets[0],residuals[0],rms[0],count[0],iterations)
+    return HelmertFit(params,used,offsets,residuals,rms,count,iterations)
+
+def apply( params, xyz ):
+    '''
+    Apply Helmert transformation parameters (7,) to coordinates (nsta,3),
+    or a set of transformations (nsol,7) to coordinates (nsta,3) or
+    (nsol,nsta,3).  Returns the transformed coordinates.
+    '''
+    params=np.asarray(params,dtype=np.float64)
+    xyz=np.asarray(xyz,dtype=np.float64)
+    t=params[...,None,0:3]
+    r=params[...,None,3:6]*1.0e-6
+    scale=params[...,None,6:7]*1.0e-6
+    return xyz+t+scale*xyz+np.cross(r,xyz)
@@ -0,0 +1,192 @@
+'''
+Optional timing and counting instrumentation of the readers in this package.
+
+Instrumentation is off unless a recorder is active, in which case the hooks
+in the readers cost a single check of a module list.  To profile a block of
+code use
+
+    with Instrument.record() as rec:
+        coords=CoordFile.read(filename)
+    print(rec.results())
+
+or rec.report() for a text summary.
+
+results returns a dictionary keyed on the reader (for example
+'CoordFile.read') of
+
+    calls    the number of calls to the reader
+    time     the total elapsed time in the reader (seconds)
+    stages   a dictionary of the total elapsed time of each stage of the
+             reader, such as io, decompress, parse, and build
+    counts   a dictionary of counts such as bytes (read from files),
+             records (parsed), skipped (records skipped due to errors),
+             and cachehits
+
+Readers called by other readers (such as CoordFile.read called by compare)
+are recorded separately.  Stages and counts are attributed to the innermost
+reader running in the same thread.  Files read in worker processes (for
+example read_many with workers) are not recorded.
+'''
+
+import functools
+import threading
+import time
+
+_recorders=[]
+_lock=threading.Lock()
+_local=threading.local()
+
+def enabled():
+    '''
+    Returns True if instrumentation is being recorded
+    '''
+    return bool(_recorders)
+
+class _NullTimer( object ):
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        return False
+
+_nulltimer=_NullTimer()
+
+def _readers():
+    stack=getattr(_local,'readers',None)
+    if stack is None:
+        stack=[]
+        _local.readers=stack
+    return stack
+
+def _current():
+    stack=_readers()
+    return stack[-1] if stack else 'unknown'
+
+class _Timer( object ):
+
+    def __init__( self, reader, stage ):
+        self._reader=reader
+        self._stage=stage
+
+    def __enter__( self ):
+        if self._reader is not None:
+            _readers().append(self._reader)
+        else:
+            self._reader=_current()
+        self._start=time.time()
+        return self
+
+    def __exit__( self, *args ):
+        elapsed=time.time()-self._start
+        if self._stage is None:
+            _readers().pop()
+        with _lock:
+            for r in _recorders:
+                r._addTime(self._reader,self._stage,elapsed)
+        return False
+
+def reader( name ):
+    '''
+    Context manager timing a call to a reader (or other top level operation)
+    '''
+    if not _recorders:
+        return _nulltimer
+    return _Timer(name,None)
+
+def instrumented( name ):
+    '''
+    Decorator recording calls to a function as a reader
+    '''
+    def decorator( func ):
+        @functools.wraps(func)
+        def wrapper( *args, **kwargs ):
+            if not _recorders:
+                return func(*args,**kwargs)
+            with _Timer(name,None):
+                return func(*args,**kwargs)
+        return wrapper
+    return decorator
+
+def stage( name ):
+    '''
+    Context manager timing a stage of the current reader
+    '''
+    if not _recorders:
+        return _nulltimer
+    return _Timer(None,name)
+
+def count( **counts ):
+    '''
+    Add to counts (such as bytes, records, skipped) of the current reader
+    '''
+    if not _recorders:
+        return
+    name=_current()
+    with _lock:
+        for r in _recorders:
+            r._addCounts(name,counts)
+
+class record( object ):
+    '''
+    Context manager recording instrumentation while it is active.  Recorders
+    may be nested, in which case each records the events within it.
+    '''
+
+    def __init__( self ):
+        self._results={}
+
+    def __enter__( self ):
+        with _lock:
+            _recorders.append(self)
+        return self
+
+    def __exit__( self, *args ):
+        with _lock:
+            _recorders.remove(self)
+        return False
+
+    def _entry( self, name ):
+        entry=self._results.get(name)
+        if entry is None:
+            entry={'calls': 0, 'time': 0.0, 'stages': {}, 'counts': {}}
+            self._results[name]=entry
+        return entry
+
+    def _addTime( self, name, stage, elapsed ):
+        entry=self._entry(name)
+        if stage is None:
+            entry['calls'] += 1
+            entry['time'] += elapsed
+        else:
+            entry['stages'][stage]=entry['stages'].get(stage,0.0)+elapsed
+
+    def _addCounts( self, name, counts ):
+        entry=self._entry(name)['counts']
+        for k, v in counts.items():
+            entry[k]=entry.get(k,0)+v
+
+    def results( self ):
+        '''
+        Returns a copy of the recorded results (see module documentation)
+        '''
+        with _lock:
+            return dict((name,{
+                'calls': entry['calls'],
+                'time': entry['time'],
+                'stages': dict(entry['stages']),
+                'counts': dict(entry['counts']),
+                }) for name, entry in self._results.items())
+
+    def report( self ):
+        '''
+        Returns the results formatted as a text table
+        '''
+        lines=[]
+        for name, entry in sorted(self.results().items()):
+            lines.append('{0:24s} {1:6d} calls {2:10.4f} s'.format(name,entry['calls'],entry['time']))
+            for stage, elapsed in sorted(entry['stages'].items()):
+                lines.append('    {0:20s}             {1:10.4f} s'.format(stage,elapsed))
+            for key, value in sorted(entry['counts'].items()):
+                lines.append('    {0:20s} {1:12d}'.format(key,int(value)))
+        return '\n'.join(lines)
@@ -0,0 +1,129 @@
+'''
+Vectorized quality control analysis of Bernese residuals.
+
+Functions take a Residuals object and group the residual records by line,
+satellite, or both (by='line', 'satellite', or 'both').  All calculations
+use sort and bincount/reduceat operations over the whole set of residuals
+rather than looping over groups.
+'''
+
+import numpy as np
+
+# Scale factor converting median absolute deviation to standard deviation
+MAD_SCALE=1.4826
+
+def groupMedian( values, group, ngroup ):
+    '''
+    Calculate the median of values for each group.  group is an array of
+    group numbers from 0 to ngroup-1 for each value.  Returns an array of
+    ngroup medians, NaN for groups without values.
+    '''
+    median=np.full((ngroup,),np.nan)
+    if len(values) == 0:
+        return median
+    order=np.lexsort((values,group))
+    svalues=values[order]
+    count=np.bincount(group,minlength=ngroup)
+    used=count > 0
+    starts=np.concatenate(([0],np.cumsum(count)[:-1]))[used]
+    count=count[used]
+    median[used]=(svalues[starts+(count-1)//2]+svalues[starts+count//2])/2.0
+    return median
+
+def robustStats( residuals, by='line' ):
+    '''
+    Calculate the median and scaled median absolute deviation (MAD) of the
+    residuals in each group.  Returns arrays of the group of each residual,
+    and the median and scaled MAD of each group.
+    '''
+    group, ngroup, order = residuals.groups(by)
+    values=residuals.residual.astype(np.float64)
+    median=groupMedian(values,group,ngroup)
+    mad=groupMedian(np.abs(values-median[group]),group,ngroup)*MAD_SCALE
+    return group, median, mad
+
+def outliers( residuals, by='line', threshold=5.0, minMad=0.0 ):
+    '''
+    Identify outlier residuals using the median and median absolute
+    deviation (MAD) of the residuals in each group.  A residual is an
+    outlier if it differs from the group median by more than threshold times
+    the scaled MAD (or minMad if this is greater).  Returns a boolean array
+    flagging the outliers in the residual records.
+    '''
+    group, median, mad = robustStats(residuals,by)
+    mad=np.maximum(mad,minMad)
+    deviation=np.abs(residuals.residual-median[group])
+    return deviation > threshold*mad[group]
+
+def outlierSummary( residuals, by='line', threshold=5.0, minMad=0.0 ):
+    '''
+    Summarise the outliers (see outliers) for each group.  Returns a pandas
+    DataFrame with columns count, median, mad, outliers, and fraction (the
+    proportion of the group's residuals that are outliers).  Sort on fraction
+    to find the worst lines or satellites.
+    '''
+    group, median, mad = robustStats(residuals,by)
+    ngroup=len(median)
+    mad=np.maximum(mad,minMad)
+    deviation=np.abs(residuals.residual-median[group])
+    isoutlier=deviation > threshold*mad[group]
+    count=np.bincount(group,minlength=ngroup)
+    noutliers=np.bincount(group,weights=isoutlier,minlength=ngroup).astype(np.int64)
+    fraction=noutliers/np.maximum(count,1).astype(np.float64)
+    data={'count': count, 'median': median, 'mad': mad, 'outliers': noutliers, 'fraction': fraction}
+    groups=np.flatnonzero(count > 0)
+    return residuals.groupFrame(by,groups,data,['count','median','mad','outliers','fraction'])
+
+def binned( residuals, window, by=None, exclude=None ):
+    '''
+    Aggregate residuals into epoch windows of window seconds, optionally
+    also grouped by line, satellite, or both.  exclude can be a boolean
+    array of records to omit, such as returned by outliers.  Returns a pandas
+    DataFrame with columns epoch (start of the window), count, mean, rms,
+    min and max.
+    '''
+    import pandas as pd
+    epoch=residuals.epoch
+    values=residuals.residual.astype(np.float64)
+    if by is not None:
+        group, ngroup, order = residuals.groups(by)
+    else:
+        group, ngroup = np.zeros(epoch.shape,dtype=np.int64), 1
+    if exclude is not None:
+        keep=~np.asarray(exclude)
+        epoch,values,group=epoch[keep],values[keep],group[keep]
+
+    columns=['epoch','count','mean','rms','min','max']
+    if len(values) == 0:
+        return pd.DataFrame(columns=columns)
+
+    bin0=int(epoch.min())//window
+    bins=epoch.astype(np.int64)//window-bin0
+    nbin=int(bins.max())+1
+    key=group.astype(np.int64)*nbin+bins
+    # Records are usually ordered by line and epoch, so this sort is close
+    # to linear
+    order=np.argsort(key,kind='stable')
+    skey=key[order]
+    svalues=values[order]
+    starts=np.flatnonzero(np.concatenate(([True],skey[1:] != skey[:-1])))
+    keys=skey[starts]
+    count=np.diff(np.concatenate((starts,[len(skey)])))
+    total=np.add.reduceat(svalues,starts)
+    sumsq=np.add.reduceat(svalues*svalues,starts)
+
+    data={
+        'epoch': ((keys % nbin)+bin0)*window,
+        'count': count,
+        'mean': total/count,
+        'rms': np.sqrt(sumsq/count),
+        'min': np.minimum.reduceat(svalues,starts),
+        'max': np.maximum.reduceat(svalues,starts),
+        }
+    result=pd.DataFrame(data,columns=columns)
+    if by is not None:
+        groups=keys//nbin
+        labels=residuals.groupFrame(by,groups,{},[])
+        labels=labels.reset_index()
+        result=pd.concat((labels,result),axis=1)
+    return result
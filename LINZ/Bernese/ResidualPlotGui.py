@@ -1,6 +1,6 @@
-#!/usr/bin/python
 """
-Simple plotting of Bernese residual file
+Interactive plotting of Bernese residual files (PyQt5).  Run with the
+plot_bernese_residuals script with no residual files.
 
 Code based on exmaple
 Eli Bendersky (eliben@gmail.com)
@@ -8,16 +8,17 @@ License: this code is in the public domain
 Last modified: 19.01.2009
 """
 import sys, os
-from PyQt4.QtCore import *
-from PyQt4.QtGui import *
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+from PyQt5.QtWidgets import *
 
 import matplotlib
-from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.backends.backend_qt4agg import NavigationToolbar2QTAgg as NavigationToolbar
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure
 
-from Bernese.Residuals import Residuals
-from Bernese import Util
+from LINZ.Bernese.Residuals import Residuals
+from LINZ.Bernese import Util
 
 
 class AppForm(QMainWindow):
@@ -36,10 +37,10 @@ class AppForm(QMainWindow):
         self.redraw()
 
     def open_file( self ):
-        filename=QFileDialog.getOpenFileName(self,'Open residual file',self._respath,"Bernese residual files (*.frs);;All files (*.*)")
+        filename=QFileDialog.getOpenFileName(self,'Open residual file',self._respath,"Bernese residual files (*.frs);;All files (*.*)")[0]
         if not filename:
             return
-        filename = unicode(filename)
+        filename = str(filename)
         self._respath = os.path.dirname(filename)
         self._residuals = None
         self.redraw()
@@ -69,9 +70,9 @@ class AppForm(QMainWindow):
     def save_plot(self):
         file_choices = "PNG file (*.png)"
         
-        path = unicode(QFileDialog.getSaveFileName(self, 
+        path = str(QFileDialog.getSaveFileName(self, 
                         'Save file', '', 
-                        file_choices))
+                        file_choices)[0])
         if path:
             self.canvas.print_figure(path, dpi=self.dpi)
             self.statusBar().showMessage('Saved to %s' % path, 2000)
@@ -229,7 +230,7 @@ class AppForm(QMainWindow):
 
     def create_action(  self, text, slot=None, shortcut=None, 
                         icon=None, tip=None, checkable=False, 
-                        signal="triggered()"):
+                        signal="triggered"):
         action = QAction(text, self)
         if icon is not None:
             action.setIcon(QIcon(":/%s.png" % icon))
@@ -239,13 +240,13 @@ class AppForm(QMainWindow):
             action.setToolTip(tip)
             action.setStatusTip(tip)
         if slot is not None:
-            self.connect(action, SIGNAL(signal), slot)
+            getattr(action, signal).connect(slot)
         if checkable:
             action.setCheckable(True)
         return action
 
 def main():
-    app = QApplication(sys.argv)
+    app = QApplication(sys.argv[:1])
     form = AppForm()
     form.show()
     app.exec_()
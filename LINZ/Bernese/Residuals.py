@@ -1,75 +1,213 @@
 import sys
 import re
 import os
+import io
 from collections import namedtuple
 import numpy as np
 
+from . import Util
+from . import Cache
+from . import Instrument
 from .Fortran import Format
 
 Line=namedtuple('Line','num,code1,code2,st1,st2,nf,offset,period')
 Line.code = lambda self: self.code1+':'+self.code2 if self.code2 else self.code1
 
+residualDtype=np.dtype([('line','i4'),('epoch','i4'),('satellite','i4'),('residual','f4')])
+
+_lineFields=('num','code1','code2','st1','st2','nf','offset','period')
+_headerItems={
+    'Type of residual file': 'filetype',
+    'Format of residual records': 'fileformat',
+    'Program created the file': 'srcprogram',
+    'Difference level of observations': 'differencing',
+    }
+
+def _skipTo(f,regex,filename):
+    while True:
+        l = f.readline()
+        if not l:
+            raise RuntimeError('Cannot interpret '+filename+' as Bernese residual file')
+        if re.match(regex,l):
+            break
+
+def _readHeader( f, filename ):
+    '''
+    Read the header of a residual file up to the start of the residual 
+    records.  Returns a dictionary of arrays for the header items and lines
+    (baselines or stations), and the array of epoch offsets for each line.
+    '''
+    arrays={}
+    while True:
+        l = f.readline()
+        if not l:
+            raise RuntimeError('Cannot interpret '+filename+' as Bernese residual file')
+        if re.match(r'^Num\s+Station\s+1',l):
+            break
+        m = re.match(r'^\s*(.*)\:\s+(.*?)\s*$',l)
+        if m and m.group(1) in _headerItems:
+            arrays[_headerItems[m.group(1)]]=np.array(m.group(2))
+    f.readline()
+
+    fmt = Format('(I3,2X,2A18,A10,3(X,I2),14X,4I2,I4,I5)')
+    lines=[]
+    offsets = [0]
+    obsdate='unspecified date'
+    period=1
+    while True:
+        l=f.readline()
+        if not l.strip():
+            break
+        num,st1,st2,obsdate,hour,min,sec,nf,f1,f2,f3,type,period=fmt.read(l)
+        offset = (hour*3600+min*60+sec)//period
+        offsets.append(offset)
+        if num != len(lines)+1:
+            raise RuntimeError('Stations numbers not right in '+filename)
+        code1,st1 = st1.split(' ',1)
+        code2,st2 = st2.split(' ',1)
+        lines.append((num,code1,code2,st1.strip(),st2.strip(),nf,offset,period))
+
+    _skipTo(f,r'^Num\s+Epoch\s+',filename)
+    f.readline()
+
+    arrays['obsdate']=np.array(obsdate)
+    arrays['period']=np.array(period)
+    for i, field in enumerate(_lineFields):
+        arrays['line_'+field]=np.array([l[i] for l in lines])
+    return arrays, np.array(offsets)
+
+# Number of characters of residual records read and parsed at a time
+blocksize=8*1024*1024
+
+def _parseRecords( text, offsets, period ):
+    '''
+    Parse a block of residual records into a structured array of line, 
+    epoch, satellite, and residual.  Fortran double precision exponents 
+    are converted in bulk so the columns can be parsed natively.
+    '''
+    import pandas as pd
+    with Instrument.stage('parse'):
+        text=text.replace('D','E').encode('latin-1')
+        if not text.strip():
+            return np.empty((0,),dtype=residualDtype)
+        # Splitting on single spaces and skipping repeated spaces is much
+        # faster than a regular expression separator.  Lines of only spaces
+        # are read as missing values and dropped.
+        table=pd.read_csv(io.BytesIO(text),sep=' ',skipinitialspace=True,header=None,
+                          usecols=(0,1,3,5),engine='c')
+        text=None
+        if table[0].isna().any():
+            table=table.dropna()
+        data=np.empty((len(table),),dtype=residualDtype)
+        for field, column in zip(residualDtype.names,(0,1,3,5)):
+            data[field]=table[column].values
+        data['epoch'] += offsets[data['line']]
+        data['epoch'] *= period
+    Instrument.count(records=len(data))
+    return data
+
+def _iterBlocks( f, offsets, period ):
+    # Parse the records following the header of an open file in blocks of
+    # about blocksize characters ending at a line break, so that only one
+    # block of text is held in memory at a time
+    while True:
+        with Instrument.stage('io'):
+            text=f.read(blocksize)
+            if text and not text.endswith('\n'):
+                text += f.readline()
+        if not text:
+            break
+        data=_parseRecords(text,offsets,period)
+        text=None
+        if len(data) > 0:
+            yield data
+
+def _readResidualArrays( filename ):
+    '''
+    Parse a residual file into a dictionary of arrays for the header 
+    items, the lines (baselines or stations), and the residual data 
+    '''
+    with Util.openfile(filename) as f:
+        with Instrument.stage('header'):
+            arrays, offsets = _readHeader(f,filename)
+        blocks=list(_iterBlocks(f,offsets,int(arrays['period'])))
+    if len(blocks) == 1:
+        arrays['data']=blocks[0]
+    else:
+        arrays['data']=np.concatenate(blocks) if blocks else np.empty((0,),dtype=residualDtype)
+    return arrays
+
+def iterchunks( filename, chunksize=1000000 ):
+    '''
+    Iterator returning the residual records of a file as a sequence of 
+    structured arrays of line, epoch, satellite, and residual, each with
+    up to chunksize records.  Only one chunk is held in memory at a time.
+    '''
+    with Util.openfile(filename) as f:
+        arrays, offsets = _readHeader(f,filename)
+        pending=[]
+        npending=0
+        for data in _iterBlocks(f,offsets,int(arrays['period'])):
+            pending.append(data)
+            npending += len(data)
+            while npending >= chunksize:
+                data=np.concatenate(pending) if len(pending) > 1 else pending[0]
+                yield data[:chunksize]
+                pending=[data[chunksize:].copy()]
+                npending=len(pending[0])
+        if npending > 0:
+            yield np.concatenate(pending)
+
+# Number of residuals above which Residuals.plot decimates by default
+maxPlotPoints=200000
+
+# Maximum memory (bytes) of a residual cube unless otherwise specified
+maxCubeBytes=2**31
+
+def _cubeBytes( nrecords, shape, sparse ):
+    # Memory of a residual cube - float32 residuals, and int64 indices if sparse
+    if sparse:
+        return nrecords*12
+    return int(np.prod(shape,dtype=np.int64))*4
+
+def _envelope( x, y, x0, width ):
+    '''
+    Reduce points to the minimum and maximum y in bins of x of the specified 
+    width starting at x0.  Returns arrays of x (the bin centres) and y with 
+    two points for each bin containing data.
+    '''
+    bins=((x-x0)//width).astype(np.int64)
+    order=np.argsort(bins,kind='stable')
+    sbins=bins[order]
+    sy=y[order]
+    starts=np.flatnonzero(np.concatenate(([True],sbins[1:] != sbins[:-1])))
+    ymin=np.minimum.reduceat(sy,starts)
+    ymax=np.maximum.reduceat(sy,starts)
+    xc=x0+(sbins[starts]+0.5)*width
+    return np.repeat(xc,2), np.column_stack((ymin,ymax)).reshape(-1)
+
 class Residuals( object ):
 
+    @Instrument.instrumented('Residuals')
     def __init__( self, filename ):
         self.filepath = filename
         self.filename = os.path.basename(filename)
         self.filetype=None
         self.fileformat=None
-        self.srccprogram='PROGRAM'
+        self.srcprogram='PROGRAM'
         self.differencing=''
-        self.obsdate='unspecified date'
-
-        f = open(filename,"r")
-        while True:
-            l = f.readline()
-            if re.match(r'^Num\s+Station\s+1',l):
-                break
-            m = re.match(r'^\s*(.*)\:\s+(.*?)\s*$',l)
-            if m:
-                item = m.group(1)
-                value = m.group(2)
-                if item=='Type of residual file':
-                    self.filetype=value
-                elif item=='Format of residual records':
-                    self.fileformat=value
-                elif item=='Program created the file':
-                    self.srcprogram=value
-                elif item=='Difference level of observations':
-                    self.differencing=value
-        f.readline()
-
-        fmt = Format('(I3,2X,2A18,A10,3(X,I2),14X,4I2,I4,I5)')
+
+        arrays=Cache.cached('RES',filename,_readResidualArrays)
+        for item in _headerItems.values():
+            if item in arrays:
+                setattr(self,item,str(arrays[item]))
         lines=[None]
-        offsets = [0]
-        while True:
-            l=f.readline()
-            if not l.strip():
-                break
-            num,st1,st2,obsdate,hour,min,sec,nf,f1,f2,f3,type,period=fmt.read(l)
-            offset = (hour*3600+min*60+sec)/period
-            offsets.append(offset)
-            if num != len(lines):
-                raise RuntimeError('Stations numbers not right in '+filename)
-            code1,st1 = st1.split(' ',1)
-            code2,st2 = st2.split(' ',1)
-            lines.append(Line(num,code1,code2,st1.strip(),st2.strip(),nf,offset,period))
-
-
-        offsets = np.array(offsets)
-        self._skipTo(f,r'^Num\s+Epoch\s+')
-        f.readline()
-        data = np.loadtxt( f,
-                          converters={5: lambda s:float(s.replace('D','E'))},
-                          dtype={'names': ('line','epoch','satellite','residual'),
-                                 'formats': ('i4','i4','i4','f4')},
-                          usecols=(0,1,3,5)
-                         )
-        data['epoch'] += offsets[data['line']]
-        data['epoch'] *= period
-                                 
-        self._data = data
-        self.obsdate=obsdate
+        linedata=[arrays['line_'+field].tolist() for field in _lineFields]
+        lines.extend(Line(*l) for l in zip(*linedata))
+
+        self._data = arrays['data']
+        self.obsdate=str(arrays['obsdate'])
+        self.period=int(arrays['period'])
         self.line=self._data['line']
         self.epoch=self._data['epoch']
         self.satellite=self._data['satellite']
@@ -77,16 +215,202 @@ class Residuals( object ):
         self.satellites=np.unique(self.satellite)
         self._lines = lines
         self.lines=lines[1:]
+        with Instrument.stage('index'):
+            self._buildIndex()
+
+    def _buildIndex( self ):
+        # Sort based index of the records for each line and satellite.  The
+        # records for line n are _lineOrder[_lineOffsets[n]:_lineOffsets[n+1]],
+        # and similarly for the satellite at index i of self.satellites.
+        self._lineCodes=dict((l.code(),l.num) for l in self.lines)
+        self._lineOrder=np.argsort(self.line,kind='stable')
+        counts=np.bincount(self.line,minlength=len(self._lines))
+        self._lineOffsets=np.concatenate(([0],np.cumsum(counts)))
+        self._satGroup=np.searchsorted(self.satellites,self.satellite)
+        self._satOrder=np.argsort(self._satGroup,kind='stable')
+        counts=np.bincount(self._satGroup,minlength=len(self.satellites))
+        self._satOffsets=np.concatenate(([0],np.cumsum(counts)))
+
+    def _lineRecords( self, line ):
+        if not isinstance(line,(int,np.integer)):
+            line=self._lineCodes.get(line,0)
+        if line < 1 or line >= len(self._lines):
+            return np.empty((0,),dtype=np.int64)
+        return self._lineOrder[self._lineOffsets[line]:self._lineOffsets[line+1]]
+
+    def _satelliteRecords( self, satellite ):
+        i=np.searchsorted(self.satellites,satellite)
+        if i >= len(self.satellites) or self.satellites[i] != satellite:
+            return np.empty((0,),dtype=np.int64)
+        return self._satOrder[self._satOffsets[i]:self._satOffsets[i+1]]
+
+    def by_line( self, line ):
+        '''
+        Returns the residual records (a structured array of line, epoch, 
+        satellite, residual) for a line, identified either by number or 
+        by code (as returned by Line.code())
+        '''
+        return self._data[self._lineRecords(line)]
+
+    def by_satellite( self, satellite ):
+        '''
+        Returns the residual records (a structured array of line, epoch, 
+        satellite, residual) for a satellite
+        '''
+        return self._data[self._satelliteRecords(satellite)]
+
+    def groups( self, by ):
+        '''
+        Returns an array of the group of each record, the number of groups,
+        and the record order sorted by group, for by='line', 'satellite', or
+        'both'.  The groups are the line number, the index of the satellite 
+        in self.satellites, or line*nsat+satellite index.  Used with 
+        groupFrame to calculate per group statistics.
+        '''
+        by=by.lower()
+        nsat=len(self.satellites)
+        if by == 'line':
+            return self.line, len(self._lines), self._lineOrder
+        elif by == 'satellite':
+            return self._satGroup, nsat, self._satOrder
+        elif by == 'both':
+            group=self.line.astype(np.int64)*nsat+self._satGroup
+            return group, len(self._lines)*nsat, np.argsort(group,kind='stable')
+        raise ValueError('Invalid residual grouping '+by)
+
+    def stats( self, by='line', outlierFactor=3.0, outlierLimit=None ):
+        '''
+        Calculate summary statistics of the residuals for each line, 
+        satellite, or line and satellite combination (by='line', 'satellite',
+        or 'both').  Returns a pandas DataFrame with columns count, mean, 
+        rms, maxabs (maximum absolute residual) and outliers (the number 
+        of residuals greater than outlierLimit, or outlierFactor times the 
+        rms of the group if outlierLimit is not defined).
+        '''
+        by=by.lower()
+        group, ngroup, order = self.groups(by)
+
+        residual=self.residual.astype(np.float64)
+        count=np.bincount(group,minlength=ngroup)
+        used=count > 0
+        ncount=np.where(used,count,1)
+        mean=np.bincount(group,weights=residual,minlength=ngroup)/ncount
+        rms=np.sqrt(np.bincount(group,weights=residual*residual,minlength=ngroup)/ncount)
+        maxabs=np.zeros((ngroup,))
+        if len(residual) > 0:
+            starts=np.concatenate(([0],np.cumsum(count)[:-1]))
+            maxabs[used]=np.maximum.reduceat(np.abs(residual[order]),starts[used])
+        limit=outlierLimit if outlierLimit is not None else outlierFactor*rms[group]
+        outliers=np.bincount(group,weights=np.abs(residual) > limit,minlength=ngroup)
+        mean[~used]=np.nan
+        rms[~used]=np.nan
+        maxabs[~used]=np.nan
+
+        select=np.arange(1,ngroup) if by == 'line' else np.flatnonzero(used)
+        data={'count': count, 'mean': mean, 'rms': rms, 'maxabs': maxabs,
+              'outliers': outliers.astype(np.int64)}
+        return self.groupFrame(by,select,data,['count','mean','rms','maxabs','outliers'])
+
+    def groupFrame( self, by, groups, data, columns ):
+        '''
+        Build a DataFrame of per group statistics, indexed by line and/or 
+        satellite.  groups is an array of the group numbers (as returned by 
+        the groups method) to include, and data is a dictionary of arrays 
+        of values for all groups, of which the columns are included.
+        '''
+        import pandas as pd
+        by=by.lower()
+        nsat=len(self.satellites)
+        data=dict((c,data[c][groups]) for c in columns)
+        columns=list(columns)
+        if by == 'line':
+            index=pd.Index(groups,name='line')
+        elif by == 'satellite':
+            index=pd.Index(self.satellites[groups],name='satellite')
+        else:
+            index=pd.MultiIndex.from_arrays(
+                (groups//nsat,self.satellites[groups % nsat]),names=('line','satellite'))
+        if by != 'satellite':
+            lines=groups if by == 'line' else groups//nsat
+            data['code']=[self._lines[i].code() for i in lines]
+            columns.insert(0,'code')
+        return pd.DataFrame(data,index=index,columns=columns)
+
+    def _cubeAxes( self, lines=None, satellites=None ):
+        # Returns the records selected by lines (numbers or codes) and 
+        # satellites, and the line numbers, epoch numbers (epoch/period), 
+        # and satellites of the cube axes.
+        select=np.ones(self.line.shape,dtype=bool)
+        linenos=np.arange(1,len(self._lines),dtype=np.int64)
+        if lines is not None:
+            lines=lines.split() if isinstance(lines,str) else lines
+            linenos=np.array(sorted(set(l if isinstance(l,(int,np.integer)) else self._lineCodes.get(l,0)
+                                        for l in lines)-set([0])),dtype=np.int64)
+            select &= np.isin(self.line,linenos)
+        sats=self.satellites
+        if satellites is not None:
+            satellites=satellites.split() if isinstance(satellites,str) else satellites
+            sats=np.intersect1d(self.satellites,np.array([int(x) for x in satellites],dtype=np.int64))
+            select &= np.isin(self.satellite,sats)
+        records=np.flatnonzero(select)
+        epochno=self.epoch[records]//self.period
+        epochs=np.arange(epochno.min(),epochno.max()+1) if len(records) else np.empty((0,),dtype=np.int64)
+        return records, linenos, epochs, sats
+
+    def cubeMemory( self, sparse=False, lines=None, satellites=None ):
+        '''
+        Returns the memory (bytes) required for the residual cube returned 
+        by cube with the same parameters, without creating it
+        '''
+        records, linenos, epochs, sats = self._cubeAxes(lines,satellites)
+        return _cubeBytes(len(records),(len(linenos),len(epochs),len(sats)),sparse)
+
+    def cube( self, sparse=False, lines=None, satellites=None, maxBytes=None ):
+        '''
+        Returns the residuals as a ResidualCube with axes line, epoch, and 
+        satellite, optionally for a subset of lines (numbers or codes) and 
+        satellites.  The cube is dense unless sparse is True.  Raises a 
+        RuntimeError if the cube would need more than maxBytes of memory 
+        (default maxCubeBytes) - use cubeMemory to check first.
+        '''
+        records, linenos, epochs, sats = self._cubeAxes(lines,satellites)
+        return ResidualCube(self,records,linenos,epochs,sats,sparse,maxBytes)
+
+    def __getstate__( self ):
+        # Array attributes are views of _data and the index is rebuilt on 
+        # loading so are not pickled 
+        state=self.__dict__.copy()
+        for attr in ('line','epoch','satellite','residual','_lineCodes','_lineOrder',
+                     '_lineOffsets','_satGroup','_satOrder','_satOffsets'):
+            state.pop(attr,None)
+        return state
+
+    def __setstate__( self, state ):
+        self.__dict__.update(state)
+        self.line=self._data['line']
+        self.epoch=self._data['epoch']
+        self.satellite=self._data['satellite']
+        self.residual=self._data['residual']
+        self._buildIndex()
+
+    def plot(self,plot=None,lines=None,satellites=None,colourby=None,colourmap=None,legend=None,title=True,decimate=None,columns=2000):
+        '''
+        Plot the residuals against epoch, coloured by line or satellite.  plot
+        can be pyplot (the default) or a matplotlib Axes.  lines and satellites
+        select the lines (by code) and satellites to plot. 
 
-    def _skipTo(self,f,regex):
-        while True:
-            l = f.readline()
-            if not l:
-                raise RuntimeError('Cannot interpret '+filename+' as Bernese residual file')
-            if re.match(regex,l):
-                break
+        decimate controls how large numbers of points are plotted:
 
-    def plot(self,plot=None,lines=None,satellites=None,colourby=None,colourmap=None,legend=None,title=True):
+           'none'      every residual is plotted
+           'envelope'  the epochs are divided into columns bins (roughly one 
+                       per pixel column) and just the minimum and maximum 
+                       residual of each colour in each bin are plotted
+           'density'   the residuals are plotted as a 2d histogram image 
+                       (not coloured by line or satellite)
+
+        The default is 'envelope' if more than maxPlotPoints residuals are 
+        selected, otherwise 'none'.
+        '''
         from matplotlib import pyplot
 
         if not plot:
@@ -112,29 +436,54 @@ class Residuals( object ):
 
         if colourby.upper()[0] == 'L':
             colcodes = linecodes
-            colfield = self.line
+            colrecords = self._lineRecords
             labels = [self._lines[i].code() for i in linecodes]
             selcodes = satellites
             selfield = self.satellite
+            nsel = np.max(self.satellites)+1 if len(self.satellites) else 1
 
         else:
             colcodes = satellites
-            colfield = self.satellite
+            colrecords = self._satelliteRecords
             labels = ['Sat '+str(i) for i in satellites]
             selcodes = linecodes
             selfield = self.line
-        mval = range(np.max(selfield)+1)
-        mval = np.array([True if i in selcodes else False for i in range(np.max(selfield)+1)])
+            nsel = len(self._lines)
+        mval = np.zeros((nsel,),dtype=bool)
+        mval[np.array(selcodes,dtype=np.int64)] = True
         mask = mval[selfield]
-        
-        if not colourmap:
-            colourmap = pyplot.get_cmap('jet',len(colcodes))
 
-        plots=[]
-        for i, c in enumerate(colcodes):
-            ma = np.logical_and(mask,colfield == c)
-            clr = colourmap(i)
-            plot.plot(self.epoch[ma],self.residual[ma],'+',color=clr,label=labels[i])
+        selected=[]
+        for c in colcodes:
+            ma = colrecords(c)
+            selected.append(ma[mask[ma]])
+        npoints=sum(len(ma) for ma in selected)
+        if decimate is None:
+            decimate = 'envelope' if npoints > maxPlotPoints else 'none'
+        decimate = str(decimate or 'none').lower()
+
+        if decimate == 'density':
+            from matplotlib.colors import LogNorm
+            records = np.concatenate(selected) if selected else np.empty((0,),dtype=np.int64)
+            plot.hist2d(self.epoch[records],self.residual[records],
+                        bins=(columns,max(columns//2,1)),cmin=1,norm=LogNorm(),
+                        cmap=colourmap)
+            legend = False
+        else:
+            if not colourmap:
+                colourmap = pyplot.get_cmap('jet',len(colcodes))
+            epochs = [self.epoch[ma] for ma in selected if len(ma)]
+            if epochs:
+                emin = min(e.min() for e in epochs)
+                emax = max(e.max() for e in epochs)
+                width = max(float(emax-emin)/columns,1.0)
+            for i, ma in enumerate(selected):
+                x = self.epoch[ma]
+                y = self.residual[ma]
+                if decimate == 'envelope' and len(ma):
+                    x, y = _envelope(x,y,emin,width)
+                clr = colourmap(i)
+                plot.plot(x,y,'+',color=clr,label=labels[i])
 
         if legend==None:
             legend = len(labels) > 1
@@ -150,7 +499,243 @@ class Residuals( object ):
         if title:
             if type(title) == bool:
                 title = self.srcprogram+' residuals: '+self.obsdate
-            pyplot.title(title)
+            if hasattr(plot,'set_title'):
+                plot.set_title(title)
+            else:
+                plot.title(title)
+
+class ResidualCube( object ):
+    '''
+    Residuals as a (line x epoch x satellite) cube, created with 
+    Residuals.cube.  The axes are defined by the attributes
+
+       lines       line numbers 
+       epochs      epochs (seconds, as in Residuals.epoch) at intervals of 
+                   the residual period
+       satellites  satellite numbers
+
+    A dense cube holds the float32 array values, with NaN where there is no
+    residual.  A sparse cube holds the sorted flat indices (into the dense
+    array) of the residuals as index, and the residuals as data.  If the
+    file has more than one residual for a line, epoch, and satellite (for
+    example for different frequencies) only the last is used.
+    '''
+
+    statistics=('count','sum','mean','rms','std','min','max')
+
+    def __init__( self, residuals, records, lines, epochs, satellites, sparse=False, maxBytes=None ):
+        self.lines=lines
+        self.epochs=epochs*residuals.period
+        self.satellites=satellites
+        self.shape=(len(lines),len(epochs),len(satellites))
+        self.sparse=sparse
+        self.values=None
+        self.index=None
+        self.data=None
+        maxBytes=maxCubeBytes if maxBytes is None else maxBytes
+        size=_cubeBytes(len(records),self.shape,sparse)
+        if size > maxBytes:
+            raise RuntimeError('Residual cube requires {0:.0f} MB, more than the maximum {1:.0f} MB'.format(
+                size/1.0e6,maxBytes/1.0e6))
+        i=np.searchsorted(lines,residuals.line[records])
+        j=residuals.epoch[records]//residuals.period-(epochs[0] if len(epochs) else 0)
+        k=np.searchsorted(satellites,residuals.satellite[records])
+        flat=(i.astype(np.int64)*self.shape[1]+j)*self.shape[2]+k
+        residual=residuals.residual[records].astype(np.float32)
+        if sparse:
+            order=np.argsort(flat,kind='stable')
+            flat=flat[order]
+            last=np.concatenate((flat[1:] != flat[:-1],[True]))
+            self.index=flat[last]
+            self.data=residual[order][last]
+        else:
+            self.values=np.full(self.shape,np.nan,dtype=np.float32)
+            self.values.reshape(-1)[flat]=residual
+
+    def nbytes( self ):
+        '''
+        Returns the memory used by the cube (bytes)
+        '''
+        if self.sparse:
+            return self.index.nbytes+self.data.nbytes
+        return self.values.nbytes
+
+    def dense( self ):
+        '''
+        Returns the dense float32 array of the cube with NaN for missing
+        residuals
+        '''
+        if not self.sparse:
+            return self.values
+        values=np.full(self.shape,np.nan,dtype=np.float32)
+        values.reshape(-1)[self.index]=self.data
+        return values
+
+    def reduce( self, statistic='mean', axis=(1,) ):
+        '''
+        Calculate a statistic of the residuals over one or more axes (0 for
+        line, 1 for epoch, 2 for satellite), returning an array over the 
+        remaining axes.  statistic is one of count, sum, mean, rms, std, min,
+        or max.  Statistics other than count and sum are NaN where there are
+        no residuals.  For example reduce('mean',(0,2)) is the mean 
+        residual of each epoch over all lines and satellites, and 
+        reduce('rms',1) is the RMS residual of each line and satellite.
+        '''
+        if statistic not in self.statistics:
+            raise ValueError('Invalid residual cube statistic '+str(statistic))
+        axis=tuple(sorted(set(a % 3 for a in np.atleast_1d(axis).tolist())))
+        keep=[a for a in range(3) if a not in axis]
+        shape=tuple(self.shape[a] for a in keep)
+        ngroup=int(np.prod(shape,dtype=np.int64))
+
+        if self.sparse:
+            values=self.data.astype(np.float64)
+            coords=np.unravel_index(self.index,self.shape)
+        else:
+            flat=self.values.reshape(-1)
+            index=np.flatnonzero(~np.isnan(flat))
+            values=flat[index].astype(np.float64)
+            coords=np.unravel_index(index,self.shape)
+        group=np.ravel_multi_index([coords[a] for a in keep],shape) if keep else np.zeros(values.shape,dtype=np.int64)
+
+        count=np.bincount(group,minlength=ngroup)
+        if statistic == 'count':
+            return count.reshape(shape)
+        total=np.bincount(group,weights=values,minlength=ngroup)
+        if statistic == 'sum':
+            return total.reshape(shape)
+        used=count > 0
+        ncount=np.where(used,count,1)
+        if statistic in ('min','max'):
+            result=np.full((ngroup,),np.nan)
+            if len(values):
+                order=np.argsort(group,kind='stable')
+                starts=np.concatenate(([0],np.cumsum(count)[:-1]))[used]
+                reduceat=np.minimum.reduceat if statistic == 'min' else np.maximum.reduceat
+                result[used]=reduceat(values[order],starts)
+        elif statistic == 'mean':
+            result=total/ncount
+        elif statistic == 'rms':
+            result=np.sqrt(np.bincount(group,weights=values*values,minlength=ngroup)/ncount)
+        else:
+            mean=total/ncount
+            dev=values-mean[group]
+            result=np.sqrt(np.bincount(group,weights=dev*dev,minlength=ngroup)/ncount)
+        result[~used]=np.nan
+        return result.reshape(shape)
+
+class LazyResiduals( object ):
+    '''
+    Lazy read-only access to the records of an uncompressed residual file.
+    The header is read on creation and the file is memory mapped.  Records 
+    are located with a binary search on the line number (residual files 
+    are ordered by line), and only the records of the requested lines are
+    parsed.  If the file is not ordered by line then the whole file is 
+    parsed on first access.
+    '''
+
+    def __init__( self, filename ):
+        import mmap
+        if Util.iscompressed(filename):
+            raise ValueError('Cannot memory map compressed file '+filename+' - use Residuals to read it')
+        self.filepath = filename
+        self.filename = os.path.basename(filename)
+        self.filetype=None
+        self.fileformat=None
+        self.srcprogram='PROGRAM'
+        self.differencing=''
+        with Util.openfile(filename) as f:
+            arrays, self._offsets = _readHeader(f,filename)
+        for item in _headerItems.values():
+            if item in arrays:
+                setattr(self,item,str(arrays[item]))
+        lines=[None]
+        linedata=[arrays['line_'+field].tolist() for field in _lineFields]
+        lines.extend(Line(*l) for l in zip(*linedata))
+        self.obsdate=str(arrays['obsdate'])
+        self.period=int(arrays['period'])
+        self._lines=lines
+        self.lines=lines[1:]
+        self._lineCodes=dict((l.code(),l.num) for l in self.lines)
+        self._ranges={}
+        self._data=None
+
+        with open(filename,'rb') as f:
+            self._mmap=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        match=re.compile(br'^Num\s+Epoch\s+',re.M).search(self._mmap)
+        start=self._mmap.find(b'\n',match.end())+1
+        start=self._mmap.find(b'\n',start)+1 if start > 0 else 0
+        self._start=start if start > 0 else len(self._mmap)
+
+    def close( self ):
+        self._mmap.close()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.close()
+
+    def _recordAt( self, pos ):
+        # Returns the start and line number of the first record starting at
+        # or after pos.  Blank lines and the end of file sort after all lines.
+        mm=self._mmap
+        if pos > self._start and mm[pos-1:pos] != b'\n':
+            pos=mm.find(b'\n',pos)+1
+            if pos == 0:
+                pos=len(mm)
+        end=mm.find(b'\n',pos)
+        fields=mm[pos:end if end >= 0 else len(mm)].split(None,1)
+        try:
+            return pos, int(fields[0])
+        except (IndexError,ValueError):
+            return pos, sys.maxsize
+
+    def _findLine( self, line ):
+        # Binary search for the offset of the first record of line or greater
+        lo, hi = self._start, len(self._mmap)
+        while lo < hi:
+            mid=(lo+hi)//2
+            if self._recordAt(mid)[1] >= line:
+                hi=mid
+            else:
+                lo=mid+1
+        return self._recordAt(lo)[0]
+
+    def _lineData( self, line ):
+        if line not in self._ranges:
+            start=self._findLine(line)
+            end=self._findLine(line+1)
+            text=self._mmap[start:end].decode('latin-1')
+            data=_parseRecords(text,self._offsets,self.period)
+            if np.any(data['line'] != line) or self._recordAt(end)[1] < line:
+                # Not ordered by line, so parse the whole file
+                if self._data is None:
+                    text=self._mmap[self._start:].decode('latin-1')
+                    self._data=_parseRecords(text,self._offsets,self.period)
+                data=self._data[self._data['line'] == line]
+            self._ranges[line]=data
+        return self._ranges[line]
+
+    def by_line( self, line ):
+        '''
+        Returns the residual records (a structured array of line, epoch, 
+        satellite, residual) for a line, identified either by number or 
+        by code (as returned by Line.code())
+        '''
+        if not isinstance(line,(int,np.integer)):
+            line=self._lineCodes.get(line,0)
+        if line < 1 or line >= len(self._lines):
+            return np.empty((0,),dtype=residualDtype)
+        return self._lineData(int(line))
+
+def read_many( filenames, workers=None ):
+    '''
+    Read a list of residual files, returning a list of Residuals objects in 
+    the same order as the files.  If workers is greater than 1 the files are
+    parsed in a pool of that many processes (0 for one per CPU).
+    '''
+    return Util.mapfiles(Residuals,filenames,workers=workers)
 
 if __name__=='__main__':
     from matplotlib import pyplot as plt
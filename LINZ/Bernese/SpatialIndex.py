@@ -0,0 +1,200 @@
+'''
+Spatial index of station XYZ coordinates.
+
+Supports finding the stations within a distance of a point, the nearest
+stations to points, and matching the stations of two coordinate sets by
+proximity.  Distances are straight line (chord) distances in metres.
+
+The index uses scipy.spatial.cKDTree if scipy is installed.  Otherwise
+searches limited to a distance use a grid of cells of that size, and
+unlimited nearest neighbour searches use a brute force search in chunks of
+numpy array operations, which is adequate for networks of up to about 10000
+stations.
+'''
+
+import numpy as np
+
+# Maximum number of point pairs calculated at once in brute force searches
+chunksize=1000000
+
+def _kdtree():
+    # scipy is imported when first needed as it is slow to import
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        return None
+    return cKDTree
+
+# Maximum number of grid cells along each axis, so that cell numbers fit in
+# a 64 bit integer
+_maxCells=2000000
+
+class SpatialIndex( object ):
+    '''
+    Spatial index of an (n,3) array of XYZ coordinates.  keys is an
+    optional list of the keys (such as station names) of the points.
+    Points with NaN coordinates are not indexed.  Results are returned as
+    rows of the coordinate array, which can be converted to keys with
+    the keys method.  If useTree is False then the brute force search is
+    used even if scipy is installed.
+    '''
+
+    def __init__( self, xyz, keys=None, useTree=True ):
+        xyz=np.asarray(xyz,dtype=np.float64).reshape((-1,3))
+        self._keys=np.asarray(keys if keys is not None else np.arange(len(xyz)),dtype=object)
+        self._rows=np.flatnonzero(np.all(np.isfinite(xyz),axis=1))
+        self._xyz=xyz[self._rows]
+        cKDTree=_kdtree() if useTree else None
+        self._tree=cKDTree(self._xyz) if cKDTree is not None else None
+
+    def __len__( self ):
+        return len(self._rows)
+
+    def keys( self, rows ):
+        '''
+        Returns the keys for an array of rows, with None for rows of -1
+        '''
+        rows=np.asarray(rows)
+        keys=np.full(rows.shape,None,dtype=object)
+        found=rows >= 0
+        keys[found]=self._keys[rows[found]]
+        return keys.tolist()
+
+    def _points( self, points ):
+        points=np.asarray(points,dtype=np.float64)
+        return points.reshape((-1,3)), points.ndim == 1
+
+    def within( self, point, radius ):
+        '''
+        Returns an array of the rows of the points within radius metres of
+        a point (XYZ), ordered by distance
+        '''
+        point=np.asarray(point,dtype=np.float64).reshape((3,))
+        if self._tree is not None:
+            found=np.array(self._tree.query_ball_point(point,radius),dtype=np.int64)
+        else:
+            d2=np.sum((self._xyz-point)**2,axis=1)
+            found=np.flatnonzero(d2 <= radius*radius)
+        distance=np.sqrt(np.sum((self._xyz[found]-point)**2,axis=1))
+        return self._rows[found[np.argsort(distance,kind='stable')]]
+
+    def nearest( self, points, k=1, maxDistance=None ):
+        '''
+        Find the k nearest points to one (3,) or more (m,3) XYZ points.
+        Returns arrays of distances and rows, of shape (m,k) (or (k,) for a
+        single point, or without the k axis if k is 1).  Where fewer than k
+        points are found (within maxDistance metres if it is specified) the
+        distance is inf and the row -1.
+        '''
+        points, single = self._points(points)
+        npts=len(points)
+        distance=np.full((npts,k),np.inf)
+        found=np.full((npts,k),-1,dtype=np.int64)
+        nk=min(k,len(self._xyz))
+        valid=np.all(np.isfinite(points),axis=1)
+        if nk > 0 and np.any(valid):
+            if self._tree is not None:
+                upper=np.inf if maxDistance is None else maxDistance
+                d, i = self._tree.query(points[valid],k=nk,distance_upper_bound=upper)
+                d=d.reshape((-1,nk))
+                i=i.reshape((-1,nk))
+                ok=np.isfinite(d)
+                i=np.where(ok,i,0)
+            elif maxDistance is not None:
+                d, i = self._gridNearest(points[valid],nk,maxDistance)
+                ok=i >= 0
+                i=np.where(ok,i,0)
+            else:
+                d, i = self._bruteNearest(points[valid],nk)
+                ok=np.ones(d.shape,dtype=bool)
+            distance[valid,:nk]=np.where(ok,d,np.inf)
+            found[valid,:nk]=np.where(ok,self._rows[i],-1)
+        if k == 1:
+            distance=distance[:,0]
+            found=found[:,0]
+        if single:
+            distance=distance[0]
+            found=found[0]
+        return distance, found
+
+    def _bruteNearest( self, points, k ):
+        npts=len(points)
+        distance=np.empty((npts,k))
+        found=np.empty((npts,k),dtype=np.int64)
+        step=max(1,chunksize//max(len(self._xyz),1))
+        for i0 in range(0,npts,step):
+            diff=points[i0:i0+step,None,:]-self._xyz[None,:,:]
+            d2=np.einsum('ijk,ijk->ij',diff,diff)
+            if k < d2.shape[1]:
+                part=np.argpartition(d2,k-1,axis=1)[:,:k]
+            else:
+                part=np.broadcast_to(np.arange(d2.shape[1]),d2.shape)
+            pd2=np.take_along_axis(d2,part,axis=1)
+            order=np.argsort(pd2,axis=1,kind='stable')
+            found[i0:i0+step]=np.take_along_axis(part,order,axis=1)
+            distance[i0:i0+step]=np.sqrt(np.take_along_axis(pd2,order,axis=1))
+        return distance, found
+
+    def _gridPairs( self, points, radius ):
+        # All pairs of points and indexed points within radius, as arrays of
+        # point, index (into self._xyz), and distance.  Indexed points are
+        # sorted into cells of at least radius, and each point is compared
+        # with the indexed points in its own and the 26 adjacent cells.
+        origin=self._xyz.min(axis=0)
+        size=max(radius,np.max(self._xyz.max(axis=0)-origin)/(_maxCells-3),1.0e-9)
+        ncell=np.int64(_maxCells)
+        def cellKeys( cells ):
+            return (cells[...,0]*ncell+cells[...,1])*ncell+cells[...,2]
+        cells=np.floor((self._xyz-origin)/size).astype(np.int64)+1
+        keys=cellKeys(cells)
+        order=np.argsort(keys,kind='stable')
+        keys=keys[order]
+
+        pcells=np.floor((points-origin)/size).astype(np.int64)+1
+        inside=np.all((pcells >= 0) & (pcells < ncell-1),axis=1)
+        pindex=np.flatnonzero(inside)
+        offsets=np.array([(i,j,k) for i in (-1,0,1) for j in (-1,0,1) for k in (-1,0,1)],dtype=np.int64)
+        qkeys=cellKeys(pcells[pindex][:,None,:]+offsets[None,:,:])
+        lo=np.searchsorted(keys,qkeys,side='left').ravel()
+        hi=np.searchsorted(keys,qkeys,side='right').ravel()
+        counts=hi-lo
+        total=int(counts.sum())
+        qi=np.repeat(np.repeat(pindex,len(offsets)),counts)
+        start=np.repeat(lo-(np.cumsum(counts)-counts),counts)
+        ri=order[start+np.arange(total)]
+        distance=np.sqrt(np.sum((points[qi]-self._xyz[ri])**2,axis=1))
+        keep=distance <= radius
+        return qi[keep], ri[keep], distance[keep]
+
+    def _gridNearest( self, points, k, radius ):
+        npts=len(points)
+        distance=np.full((npts,k),np.inf)
+        found=np.full((npts,k),-1,dtype=np.int64)
+        qi, ri, d = self._gridPairs(points,radius)
+        order=np.lexsort((d,qi))
+        qi=qi[order]
+        start=np.searchsorted(qi,qi,side='left')
+        rank=np.arange(len(qi))-start
+        keep=rank < k
+        distance[qi[keep],rank[keep]]=d[order][keep]
+        found[qi[keep],rank[keep]]=ri[order][keep]
+        return distance, found
+
+    def match( self, points, tolerance ):
+        '''
+        Match points (m,3) to the indexed points by proximity.  Each point
+        is matched to the nearest indexed point within tolerance metres,
+        provided that it is also the nearest of the points to that indexed
+        point, so that matches are one to one.  Returns the array of matched
+        rows (-1 where there is no match) for each point.
+        '''
+        points, single = self._points(points)
+        distance, rows = self.nearest(points,maxDistance=tolerance)
+        other=SpatialIndex(points,useTree=self._tree is not None)
+        matched=rows >= 0
+        back=np.full(rows.shape,-1,dtype=np.int64)
+        if np.any(matched):
+            xyz=self._xyz[np.searchsorted(self._rows,rows[matched])]
+            back[matched]=other.nearest(xyz,maxDistance=tolerance)[1]
+        rows=np.where(matched & (back == np.arange(len(rows))),rows,-1)
+        return rows[0] if single else rows
@@ -0,0 +1,139 @@
+'''
+Generators of synthetic Bernese files for benchmarking and testing.
+
+Stations are given unique four character codes and DOMES style numbers, and
+positions scattered over a region on the GRS80 ellipsoid with velocities
+from a rigid plate rotation plus noise.  Residual files have a configurable
+number of lines (baselines), epochs and satellites with random data gaps.
+All generators take a seed so that the files are reproducible.
+'''
+
+import datetime
+import numpy as np
+
+from . import Util
+from . import CoordFile
+from . import ClusterFile
+from . import FixFile
+
+# Default region (lon min, lon max, lat min, lat max) - New Zealand
+defaultRegion=(166.0,179.0,-47.5,-34.0)
+
+# Plate rotation vector (radians/year) used for velocities
+plateRotation=np.array([-1.5e-9,4.5e-10,-3.5e-9])
+
+def _codes( nstations, rng ):
+    # Unique 4 character codes from a random sample of AAAA to ZZZZ
+    if nstations > 26**4:
+        raise ValueError('Cannot generate more than '+str(26**4)+' station codes')
+    values=rng.choice(26**4,size=nstations,replace=False)
+    letters=np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+    chars=[letters[(values//26**i) % 26] for i in (3,2,1,0)]
+    return [''.join(c) for c in zip(*chars)]
+
+def stations( nstations, seed=0, region=None, velocities=True, datum='IGb08', crddate=None ):
+    '''
+    Generate a CoordSet of nstations synthetic stations within a region
+    (lon min, lon max, lat min, lat max in degrees, default defaultRegion).
+    If velocities is True then stations have velocities from plateRotation
+    with 1mm/year noise.  crddate defaults to 2016-10-17.
+    '''
+    rng=np.random.default_rng(seed)
+    lonmin,lonmax,latmin,latmax=region or defaultRegion
+    lon=rng.uniform(lonmin,lonmax,nstations)
+    slat=rng.uniform(np.sin(np.radians(latmin)),np.sin(np.radians(latmax)),nstations)
+    lat=np.degrees(np.arcsin(slat))
+    hgt=rng.gamma(2.0,150.0,nstations)
+    xyz=np.round(CoordFile._xyz(lon,lat,hgt),4)
+    codes=_codes(nstations,rng)
+    domes=rng.integers(10000,99999,nstations)
+    names=['{0} {1:05d}M{2:03d}'.format(c,d,1+i % 3) for i,(c,d) in enumerate(zip(codes,domes))]
+    vxyz=None
+    if velocities:
+        vxyz=np.cross(plateRotation,xyz)+rng.normal(0.0,0.001,xyz.shape)
+        vxyz=np.round(vxyz,4)
+    flags=rng.choice(['A','W','M'],size=nstations,p=[0.8,0.15,0.05])
+    crddate=crddate or datetime.datetime(2016,10,17)
+    return CoordFile.CoordSet(np.arange(1,nstations+1),codes,names,xyz,vxyz,flags,
+                              datum=datum,crddate=crddate)
+
+def writeCoordinates( filename, nstations=1000, seed=0, velocities=True, **kwargs ):
+    '''
+    Write a synthetic coordinate file, and a matching velocity file if
+    velocities is True.  Other keyword arguments are passed to stations.
+    Returns the CoordSet written.
+    '''
+    coords=stations(nstations,seed=seed,velocities=velocities,**kwargs)
+    CoordFile.write(filename,coords,title='SYNTHETIC COORDINATES',velocities=velocities)
+    return coords
+
+def writeClusters( filename, coords, nclusters=10 ):
+    '''
+    Write a cluster file assigning the stations of a CoordSet to nclusters
+    clusters in order of longitude
+    '''
+    order=np.argsort(CoordFile._geodetic(coords.xyz)[0],kind='stable')
+    cluster=np.empty((len(order),),dtype=np.int64)
+    cluster[order]=np.arange(len(order))*nclusters//max(len(order),1)+1
+    ClusterFile.write(filename,dict(zip(coords.name.tolist(),cluster.tolist())),
+                      title='SYNTHETIC CLUSTERS')
+
+def writeFixed( filename, coords, nfixed=10, seed=0 ):
+    '''
+    Write a station (fix) file of nfixed stations randomly selected from a
+    CoordSet
+    '''
+    rng=np.random.default_rng(seed)
+    nfixed=min(nfixed,len(coords))
+    rows=np.sort(rng.choice(len(coords),size=nfixed,replace=False))
+    FixFile.write(filename,coords.name[rows].tolist(),title='SYNTHETIC FIXED STATIONS')
+
+def writeResiduals( filename, nlines=10, nepochs=2880, nsatellites=32, period=30,
+                    gapFraction=0.1, sigma=0.003, seed=0, chunksize=1000000 ):
+    '''
+    Write a synthetic double difference residual file.  Each line has
+    residuals for nsatellites satellites at nepochs epochs of period
+    seconds, with a random fraction gapFraction missing, and standard
+    deviation sigma metres.  Lines start at one minute intervals.  The file
+    is written in chunks of about chunksize records.  Returns the number of
+    residual records written.
+    '''
+    rng=np.random.default_rng(seed)
+    header=Util.headerlines('SYNTHETIC RESIDUALS')
+    header.extend((
+        '',
+        'Type of residual file:            DOUBLE-DIFFERENCE',
+        'Program created the file:         GPSEST',
+        'Format of residual records:       2',
+        'Difference level of observations: DOUBLE',
+        '',
+        'Num  Station 1         Station 2         Date       Time       ',
+        '-'*80,
+        ))
+    for i in range(nlines):
+        start=60*i
+        header.append('{0:3d}  {1:<18s}{2:<18s}{3:<10s} {4:2d} {5:2d} {6:2d}{7:14s}{8:2d}{9:2d}{10:2d}{11:2d}{12:4d}{13:5d}'.format(
+            i+1,'S{0:03d} {1:05d}M001'.format(i % 1000,10000+i),
+            'S{0:03d} {1:05d}M001'.format((i+1) % 1000,10001+i),
+            '2016-10-17',start//3600 % 24,start//60 % 60,start % 60,'',1,3,0,0,2,period))
+    header.extend(('','','Num  Epoch  Frq  Sat  Sat  Value','-'*50))
+
+    recfmt='{0:5d} {1:6d} {2:3d} {3:4d} {4:4d} {5:13.5E}\n'.format
+    nrecords=0
+    epochsPerChunk=max(1,chunksize//max(nsatellites,1))
+    with Util.openoutput(filename) as f:
+        f.write('\n'.join(header)+'\n')
+        for line in range(1,nlines+1):
+            for epoch0 in range(0,nepochs,epochsPerChunk):
+                epochs=np.arange(epoch0+1,min(epoch0+epochsPerChunk,nepochs)+1)
+                epoch=np.repeat(epochs,nsatellites)
+                satellite=np.tile(np.arange(1,nsatellites+1),len(epochs))
+                keep=rng.random(len(epoch)) >= gapFraction
+                epoch=epoch[keep].tolist()
+                satellite=satellite[keep].tolist()
+                residual=rng.normal(0.0,sigma,len(epoch)).tolist()
+                text=''.join([recfmt(line,e,3,s,0,r) for e,s,r in zip(epoch,satellite,residual)])
+                # Bernese writes double precision exponents
+                f.write(text.replace('E','D'))
+                nrecords += len(epoch)
+    return nrecords
@@ -0,0 +1,131 @@
+'''
+Build station coordinate time series from a set of (daily) Bernese coordinate
+files.  Files are read one at a time so that only one file's text is held in 
+memory (plus the decompressed text of the next file if it is compressed), 
+and the coordinates are accumulated as arrays.  The epoch of each 
+solution is taken from the datum line of the file.
+'''
+# Imports to support python 3 compatibility
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import glob
+import os
+import os.path
+import re
+import numpy as np
+
+from . import Util
+from . import CoordFile
+from . import Instrument
+
+try:
+    basestring
+except NameError:
+    basestring=str
+
+def crdfiles( source ):
+    '''
+    Expand the source into a sorted list of coordinate files.  The source can
+    be a directory (all .CRD files, possibly compressed, are used), a glob
+    pattern, a file name, or a list of these.
+    '''
+    if isinstance(source,basestring):
+        source=[source]
+    files=[]
+    for s in source:
+        s=Util.expandpath(s)
+        if os.path.isdir(s):
+            files.extend(os.path.join(s,f) for f in os.listdir(s)
+                         if re.search(r'\.CRD(?:\.gz|\.bz2|\.Z)?$',f,re.I))
+        elif re.search(r'[\*\?\[]',s):
+            files.extend(glob.glob(s))
+        else:
+            files.append(s)
+    return sorted(set(files))
+
+def itersolutions( source, useCode=False, skipError=True ):
+    '''
+    Iterator returning (filename, CoordSet) for each coordinate file in 
+    the source (see crdfiles).  Files that cannot be read are skipped if 
+    skipError is True.  Compressed files are decompressed one file ahead
+    of reading in a separate thread.
+    '''
+    files=crdfiles(source)
+    with Util.prefetch(files,workers=1,lookahead=1):
+        for f in files:
+            try:
+                crddata=CoordFile.read(f,useCode=useCode,skipError=skipError,coordSet=True)
+            except Exception:
+                if not skipError:
+                    raise
+                continue
+            yield f, crddata
+
+@Instrument.instrumented('TimeSeries.read')
+def read( source, codes=None, useCode=False, skipError=True ):
+    '''
+    Read a time series of coordinates from a set of coordinate files (see 
+    crdfiles).  Returns a long format pandas DataFrame with columns
+
+       epoch  the coordinate epoch of the solution
+       code   the station code (or name if useCode is False)
+       name   the full station name
+       X,Y,Z  the station coordinates
+       flag   the station flag
+       file   the name of the coordinate file
+
+    Can take a list of codes to include as either a list or a space separated
+    string.  The DataFrame is sorted by code and epoch.
+    '''
+    import pandas as pd
+    if isinstance(codes,basestring):
+        codes=codes.split()
+    epochs=[]
+    keys=[]
+    names=[]
+    xyz=[]
+    flags=[]
+    files=[]
+    for filename, crddata in itersolutions(source,useCode=useCode,skipError=skipError):
+        rows=np.arange(len(crddata))
+        if codes is not None:
+            rows=crddata.rows(codes)
+            rows=rows[rows >= 0]
+        nrows=len(rows)
+        epochs.append(np.full(nrows,np.datetime64(crddata.crddate,'s')))
+        keys.append((crddata.code if useCode else crddata.name)[rows])
+        names.append(crddata.name[rows])
+        xyz.append(crddata.xyz[rows])
+        flags.append(crddata.flag[rows])
+        files.append(np.full(nrows,filename,dtype=object))
+
+    if not epochs:
+        return pd.DataFrame(columns=['epoch','code','name','X','Y','Z','flag','file'])
+    xyz=np.vstack(xyz)
+    df=pd.DataFrame({
+        'epoch': np.concatenate(epochs),
+        'code': np.concatenate(keys).astype(object),
+        'name': np.concatenate(names).astype(object),
+        'X': xyz[:,0],
+        'Y': xyz[:,1],
+        'Z': xyz[:,2],
+        'flag': np.concatenate(flags).astype(object),
+        'file': np.concatenate(files),
+        },columns=['epoch','code','name','X','Y','Z','flag','file'])
+    df.sort_values(['code','epoch'],inplace=True,kind='mergesort')
+    df.reset_index(drop=True,inplace=True)
+    return df
+
+def byStation( timeseries ):
+    '''
+    Split a long format time series (as returned by read) into a dictionary
+    keyed on code of DataFrames indexed by epoch
+    '''
+    result={}
+    for code, data in timeseries.groupby('code',sort=True):
+        data=data.drop('code',axis=1).set_index('epoch')
+        result[code]=data
+    return result
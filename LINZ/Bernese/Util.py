@@ -1,7 +1,13 @@
 import os
 import re
+import collections
 import os.path
-import sys
+import functools
+import datetime
+import io
+import threading
+
+from . import Instrument
 
 datadir=os.environ.get('P','')
 userdir=os.environ.get('U','')
@@ -13,22 +19,235 @@ def expandpath( path ):
 def userfile( *names ):
     return os.path.join(userdir,*names) if userdir else ''
 
-def campaignfile( *names ):
+_activeCampaign=(None,'')
+
+def activecampaign():
+    '''
+    Returns the directory of the active campaign defined in the user's
+    MENU.INP file, or an empty string if it is not defined.  The file is 
+    only read again if its modification time or size changes.
+    '''
+    global _activeCampaign
+    menufile=userfile('PAN','MENU.INP')
+    try:
+        stat=os.stat(menufile)
+    except OSError:
+        return ''
+    key=(menufile,stat.st_mtime,stat.st_size)
+    if _activeCampaign[0] == key:
+        return _activeCampaign[1]
     campdir=''
     try:
-        with open(userfile('PAN','MENU.INP')) as mi:
+        with open(menufile) as mi:
             for l in mi:
                 m = re.match(r'\s*ACTIVE_CAMPAIGN\s+\d+\s+\"([^\"]*)\"\s*$',l)
                 if m:
                     campdir=expandpath(m.group(1))
                     break
-        if campdir:
-            return os.path.join(campdir,*names)
     except:
         pass
+    _activeCampaign=(key,campdir)
+    return campdir
+
+def campaignfile( *names ):
+    campdir=activecampaign()
+    if campdir:
+        return os.path.join(campdir,*names)
     return ''
 
+# Encoding and buffer size used for reading Bernese text files
+encoding='latin-1'
+buffersize=1024*1024
+
+# Prefetched decompressed files keyed on absolute path, and the prefetch 
+# context responsible for each path that has not yet been opened
+_prefetched={}
+_prefetchOwners={}
+_prefetchLock=threading.Lock()
+
+def _decompress( filename ):
+    # Returns the decompressed contents of a file as bytes, or None if the 
+    # file is not compressed
+    if filename.endswith('.gz'):
+        import gzip
+        with open(filename,'rb') as f:
+            return gzip.decompress(f.read())
+    if filename.endswith('.bz2'):
+        import bz2
+        with open(filename,'rb') as f:
+            return bz2.decompress(f.read())
+    if filename.endswith('.Z'):
+        # Unix compress files are not supported by the standard library, but 
+        # can be decompressed by gzip or uncompress
+        import subprocess
+        for command in (['gzip','-dc'],['uncompress','-c']):
+            try:
+                return subprocess.check_output(command+[filename])
+            except (OSError,subprocess.CalledProcessError):
+                pass
+        raise IOError('Cannot decompress '+filename+' - requires gzip or uncompress')
+    return None
+
+def iscompressed( filename ):
+    '''
+    Returns True if the file name has a compressed file extension (.gz, 
+    .bz2, or .Z)
+    '''
+    return filename.endswith(('.gz','.bz2','.Z'))
+
+def openfile( filename ):
+    '''
+    Open a Bernese text file for reading, decompressing it if the name ends 
+    with .gz, .bz2 or .Z.  .gz and .bz2 files are decompressed as they are 
+    read, .Z files and files decompressed by prefetch are read from memory.
+    The file is opened in text mode with a large buffer.
+    '''
+    if Instrument.enabled():
+        Instrument.count(bytes=os.path.getsize(filename))
+    if iscompressed(filename):
+        key=os.path.abspath(expandpath(filename))
+        with _prefetchLock:
+            future=_prefetched.pop(key,None)
+            owner=_prefetchOwners.pop(key,None)
+        if owner is not None:
+            owner._consumed(key)
+        if future is None and filename.endswith('.gz'):
+            import gzip
+            stream=gzip.open(filename,'rb')
+        elif future is None and filename.endswith('.bz2'):
+            import bz2
+            stream=bz2.open(filename,'rb')
+        else:
+            with Instrument.stage('decompress'):
+                data=future.result() if future is not None else _decompress(filename)
+            stream=io.BytesIO(data)
+        return io.TextIOWrapper(io.BufferedReader(stream,buffersize),encoding=encoding)
+    return io.open(filename,'r',encoding=encoding,buffering=buffersize)
+
+def readtext( filename ):
+    '''
+    Read the whole of a (possibly compressed) Bernese text file as a string
+    '''
+    with openfile(filename) as f:
+        return f.read()
+
+@Instrument.instrumented('Util.prefetch')
+def _prefetchFile( filename ):
+    with Instrument.stage('decompress'):
+        return _decompress(filename)
+
+class prefetch( object ):
+    '''
+    Context manager to decompress a list of files in parallel threads while 
+    they are being read.  Within the context openfile uses the decompressed
+    data rather than decompressing the file again.  Decompression runs 
+    outside the python global interpreter lock so overlaps with parsing.
+
+    Files are decompressed ahead of reading in the order of the list.  At
+    most lookahead files are decompressed and not yet opened at any time,
+    so memory is bounded however many files are listed.  Each time a file
+    is opened the next file in the list is submitted for decompression.
+
+    paths - the files that will be read
+    workers - the number of decompression threads (default up to 4)
+    lookahead - the number of files decompressed ahead of reading (default
+           twice the number of workers)
+    '''
+
+    def __init__( self, paths, workers=None, lookahead=None ):
+        keys=[os.path.abspath(expandpath(p)) for p in paths if iscompressed(p)]
+        self._paths=list(collections.OrderedDict.fromkeys(keys))
+        self._workers=workers or min(4,os.cpu_count() or 1)
+        self._lookahead=max(1,lookahead or 2*self._workers)
+        self._pending=collections.deque()
+        self._pool=None
+
+    def __enter__( self ):
+        if self._paths:
+            from concurrent.futures import ThreadPoolExecutor
+            self._pool=ThreadPoolExecutor(max_workers=self._workers)
+            with _prefetchLock:
+                for p in self._paths:
+                    if p not in _prefetchOwners:
+                        _prefetchOwners[p]=self
+                        self._pending.append(p)
+                for i in range(self._lookahead):
+                    self._submitNext()
+        return self
+
+    def _submitNext( self ):
+        # Submit the next pending file for decompression.  Must be called
+        # with _prefetchLock held.
+        if self._pool is not None and self._pending:
+            p=self._pending.popleft()
+            _prefetched[p]=self._pool.submit(_prefetchFile,p)
+
+    def _consumed( self, key ):
+        # Called by openfile when a file of this context is opened
+        with _prefetchLock:
+            try:
+                # Opened before it was submitted, so it is read directly
+                self._pending.remove(key)
+            except ValueError:
+                self._submitNext()
+
+    def __exit__( self, *args ):
+        if self._pool is not None:
+            with _prefetchLock:
+                self._pending.clear()
+                for p in self._paths:
+                    if _prefetchOwners.get(p) is self:
+                        del _prefetchOwners[p]
+                        future=_prefetched.pop(p,None)
+                        if future is not None:
+                            future.cancel()
+            self._pool.shutdown(wait=True)
+            self._pool=None
 
+def openoutput( filename ):
+    '''
+    Open a file for writing text, compressing it if the name ends with .gz
+    or .bz2
+    '''
+    if filename.endswith('.gz'):
+        import gzip
+        return gzip.open(filename,'wt',encoding=encoding)
+    if filename.endswith('.bz2'):
+        import bz2
+        return bz2.open(filename,'wt',encoding=encoding)
+    return io.open(filename,'w',encoding=encoding)
 
+def headerlines( title=None, created=None ):
+    '''
+    Returns the title and underline lines used at the top of Bernese files,
+    with the title in columns 1-64 and the creation date and time from
+    column 66.  created defaults to the current time.
+    '''
+    if created is None:
+        created=datetime.datetime.now()
+    created=created.strftime('%d-%b-%y %H:%M').upper()
+    return [(title or '')[:64].ljust(64)+' '+created,'-'*80]
 
+def mapfiles( func, paths, workers=None, **kwargs ):
+    '''
+    Apply a file reading function to each of a list of files and return a 
+    list of the results in the same order as the files.  When the files are
+    read in this process compressed files are decompressed ahead of reading
+    in parallel threads (see prefetch).
 
+    func - the reading function, called as func(path,**kwargs).  This must be
+           a module level function so that it can be sent to worker processes
+    paths - the list of files to read
+    workers - the number of worker processes.  If None or 1 the files are read
+           in this process.  If 0 then one worker per CPU is used.
+    '''
+    paths=list(paths)
+    reader=functools.partial(func,**kwargs) if kwargs else func
+    if workers is None or workers == 1 or len(paths) < 2:
+        with prefetch(paths):
+            return [reader(p) for p in paths]
+    from concurrent.futures import ProcessPoolExecutor
+    workers=workers or os.cpu_count() or 1
+    chunksize=max(1,len(paths)//(workers*4))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(reader,paths,chunksize=chunksize))
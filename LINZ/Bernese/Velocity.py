@@ -0,0 +1,243 @@
+'''
+Batch estimation of station velocities from coordinate time series.
+
+Each coordinate component of each station is modelled as
+
+   x(t) = x0 + v*t [+ annual and semi-annual terms] [+ offsets]
+
+where t is (date-refdate).days/365.242 years, the same calculation as
+StationCoord.epochXyz, so that x0 and v can be written as the coordinates
+and velocities of a CRD/VEL file with coordinate date refdate.  Offsets are
+steps in the coordinates at given dates.
+
+The models of all stations share one design matrix and are fitted together
+by batched least squares, with missing observations given zero weight.
+Robust fitting iteratively reweights epochs with large residuals (Huber
+weights on the residual vector normalised by the median absolute deviation
+of each component).
+
+For example
+
+    fit=Velocity.fromFiles('${P}/CAMP/STA/*.CRD',refdate=datetime.datetime(2020,1,1),
+                           annual=True,robust=True)
+    CoordFile.write('CAMP.CRD',fit.coords,velocities=True)
+'''
+
+import warnings
+from collections import namedtuple
+import numpy as np
+
+from . import Instrument
+
+VelocityFit=namedtuple('VelocityFit','coords refdate terms params xyz vxyz sigmaXyz sigmaVxyz rms count weights')
+VelocityFit.__doc__='''
+Result of a velocity estimation.  For nsta stations, nepoch epochs, and
+nterm model terms:
+
+   coords     CoordSet of the stations with coordinates and velocities at
+              refdate (fromFiles only, otherwise None)
+   refdate    the reference date of the coordinates
+   terms      names of the model terms (x0, v, annual_sin, annual_cos,
+              semiannual_sin, semiannual_cos, offset_YYYY-MM-DD)
+   params     (nsta,nterm,3) estimated parameters, 0 for offsets not
+              applying to a station
+   xyz        (nsta,3) coordinates at refdate
+   vxyz       (nsta,3) velocities (metres/year)
+   sigmaXyz   (nsta,3) standard errors of xyz
+   sigmaVxyz  (nsta,3) standard errors of vxyz
+   rms        (nsta,3) weighted RMS residual of each component
+   count      (nsta,) number of epochs with observations
+   weights    (nsta,nepoch) final weights of the observations
+'''
+
+# Huber weight function threshold in robust standard deviations
+huberThreshold=1.5
+
+def _years( dates, refdate ):
+    return np.array([(d-refdate).days/365.242 for d in dates],dtype=np.float64)
+
+def _design( dates, refdate, annual, semiannual, offsetDates ):
+    t=_years(dates,refdate)
+    columns=[np.ones(t.shape),t]
+    terms=['x0','v']
+    for include, name, freq in ((annual,'annual',2.0),(semiannual,'semiannual',4.0)):
+        if include:
+            columns.extend((np.sin(freq*np.pi*t),np.cos(freq*np.pi*t)))
+            terms.extend((name+'_sin',name+'_cos'))
+    for d in offsetDates:
+        columns.append(_years(dates,d) >= 0.0)
+        terms.append('offset_'+d.strftime('%Y-%m-%d'))
+    return np.column_stack(columns).astype(np.float64), terms
+
+def _offsetMask( offsets, nsta ):
+    # Returns the sorted offset dates and the (nsta,noffset) mask of offsets
+    # applying to each station
+    if offsets is None:
+        return [], np.zeros((nsta,0),dtype=bool)
+    if not isinstance(offsets,dict):
+        dates=sorted(set(offsets))
+        return dates, np.ones((nsta,len(dates)),dtype=bool)
+    dates=sorted(set(d for ds in offsets.values() for d in ds))
+    column=dict((d,i) for i,d in enumerate(dates))
+    mask=np.zeros((nsta,len(dates)),dtype=bool)
+    for row, ds in offsets.items():
+        for d in ds:
+            mask[row,column[d]]=True
+    return dates, mask
+
+def _robustScale( residuals, used ):
+    # Median absolute deviation of each station component scaled to a
+    # standard deviation (nsta,3)
+    values=np.where(used[:,:,None],np.abs(residuals),np.nan)
+    with warnings.catch_warnings():
+        # All NaN slices for stations without observations
+        warnings.simplefilter('ignore',RuntimeWarning)
+        scale=1.4826*np.nanmedian(values,axis=1)
+    return np.where(np.isfinite(scale) & (scale > 0),scale,np.inf)
+
+@Instrument.instrumented('Velocity.estimate')
+def estimate( dates, xyz, refdate=None, annual=False, semiannual=False, offsets=None,
+              robust=False, maxIterations=10, minEpochs=3 ):
+    '''
+    Estimate coordinates and velocities of nsta stations from coordinates
+    xyz (nepoch,nsta,3) at dates (list of nepoch dates), with NaN for
+    missing observations.  refdate is the reference date of the estimated
+    coordinates (default the middle of the date range).  If annual or
+    semiannual are True then sinusoidal terms with periods of one year and
+    half a year are included.  offsets is either a list of dates at which
+    all stations have a coordinate offset, or a dictionary keyed on station
+    (row of xyz) of lists of offset dates.  If robust is True then the fit
+    is iteratively reweighted up to maxIterations times.  Stations with
+    fewer than minEpochs observations have NaN coordinates and velocities.
+    Returns a VelocityFit (with coords None).
+    '''
+    xyz=np.asarray(xyz,dtype=np.float64)
+    nepoch, nsta = xyz.shape[:2]
+    if len(dates) != nepoch:
+        raise ValueError('Number of dates does not match coordinate array')
+    if refdate is None:
+        refdate=min(dates)+(max(dates)-min(dates))//2
+    offsetDates, offsetMask = _offsetMask(offsets,nsta)
+    design, terms = _design(dates,refdate,annual,semiannual,offsetDates)
+    nterm=design.shape[1]
+    active=np.ones((nsta,nterm),dtype=bool)
+    active[:,nterm-len(offsetDates):]=offsetMask
+
+    # Observations as (nsta,nepoch,3) relative to the mean coordinate of
+    # each station for numerical stability
+    obs=xyz.transpose((1,0,2))
+    used=np.all(np.isfinite(obs),axis=2)
+    count=np.sum(used,axis=1)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        mean=np.einsum('se,sec->sc',used,np.where(used[:,:,None],obs,0.0))/count[:,None]
+    mean[count == 0]=0.0
+    obs=np.where(used[:,:,None],obs-mean[:,None,:],0.0)
+    activeMask=(active[:,:,None] & active[:,None,:]).astype(np.float64)
+
+    weights=used.astype(np.float64)
+    for iteration in range(maxIterations if robust else 1):
+        normal=np.einsum('se,ei,ej->sij',weights,design,design,optimize=True)*activeMask
+        rhs=np.einsum('se,ei,sec->sic',weights,design,obs,optimize=True)*active[:,:,None]
+        cofactor=np.linalg.pinv(normal)
+        params=np.einsum('sij,sjc->sic',cofactor,rhs)
+        residuals=obs-np.einsum('ei,sic->sec',design,params)
+        if not robust or iteration == maxIterations-1:
+            break
+        scale=_robustScale(residuals,used)
+        u=np.sqrt(np.sum((residuals/scale[:,None,:])**2,axis=2)/3.0)
+        newWeights=np.where(used,np.where(u > huberThreshold,huberThreshold/np.maximum(u,1.0e-30),1.0),0.0)
+        if np.allclose(newWeights,weights,atol=1.0e-4):
+            break
+        weights=newWeights
+
+    # Variance factor per station component from the weighted residuals
+    rank=np.linalg.matrix_rank(normal)
+    dof=np.maximum(count-rank,1)
+    wss=np.einsum('se,sec->sc',weights,residuals**2)
+    variance=wss/dof[:,None]
+    with np.errstate(invalid='ignore',divide='ignore'):
+        rms=np.sqrt(wss/np.sum(weights,axis=1)[:,None])
+    sigma=np.sqrt(np.abs(np.diagonal(cofactor,axis1=1,axis2=2)))
+    params[:,0,:] += mean
+
+    bad=count < max(minEpochs,1)
+    params[bad]=np.nan
+    rms[bad]=np.nan
+    return VelocityFit(
+        None,refdate,terms,params,
+        params[:,0,:].copy(),
+        params[:,1,:].copy(),
+        np.where(bad[:,None],np.nan,sigma[:,0,None]*np.sqrt(variance)),
+        np.where(bad[:,None],np.nan,sigma[:,1,None]*np.sqrt(variance)),
+        rms,count,weights)
+
+@Instrument.instrumented('Velocity.fromFiles')
+def fromFiles( source, refdate=None, codes=None, useCode=False, skipError=True, **options ):
+    '''
+    Estimate coordinates and velocities from a set of (daily) coordinate
+    files (see TimeSeries.crdfiles).  The date of each solution is the
+    coordinate date of its file.  codes is an optional list of the stations
+    to include.  offsets in options may be a dictionary keyed on station
+    code (or name).  Other options are as for estimate.  Returns a
+    VelocityFit including coords, a CoordSet of the stations with at least
+    minEpochs observations, ready to write with CoordFile.write.
+    '''
+    from . import CoordFile
+    from . import TimeSeries
+
+    if isinstance(codes,str):
+        codes=codes.split()
+    if codes is not None:
+        codes=set(codes)
+    keys={}
+    stncodes=[]
+    names=[]
+    flags=[]
+    dates=[]
+    solutions=[]
+    datum=None
+    for filename, crddata in TimeSeries.itersolutions(source,useCode=useCode,skipError=skipError):
+        if crddata.crddate is None:
+            continue
+        skeys=(crddata.code if useCode else crddata.name).tolist()
+        rows=[]
+        for i, k in enumerate(skeys):
+            if codes is not None and k not in codes:
+                continue
+            if k not in keys:
+                keys[k]=len(keys)
+                stncodes.append(None)
+                names.append(None)
+                flags.append(None)
+            row=keys[k]
+            stncodes[row]=crddata.code[i]
+            names[row]=crddata.name[i]
+            flags[row]=crddata.flag[i]
+            rows.append((row,i))
+        dates.append(crddata.crddate)
+        solutions.append((np.array([r for r,i in rows],dtype=np.int64),
+                          crddata.xyz[[i for r,i in rows]]))
+        datum=crddata.datum
+
+    with Instrument.stage('build'):
+        xyz=np.full((len(dates),len(keys),3),np.nan)
+        for e, (rows, sxyz) in enumerate(solutions):
+            xyz[e,rows]=sxyz
+        solutions=None
+
+    offsets=options.get('offsets')
+    if isinstance(offsets,dict):
+        options['offsets']=dict((keys[k],v) for k,v in offsets.items() if k in keys)
+    if not dates:
+        raise RuntimeError('No coordinate solutions found in '+str(source))
+    fit=estimate(dates,xyz,refdate=refdate,**options)
+
+    good=np.flatnonzero(np.all(np.isfinite(fit.xyz),axis=1))
+    coords=CoordFile.CoordSet(
+        np.arange(1,len(good)+1),
+        [stncodes[i] for i in good],
+        [names[i] for i in good],
+        fit.xyz[good],fit.vxyz[good],
+        [flags[i] for i in good],
+        datum=datum,crddate=fit.refdate,useCode=useCode)
+    return fit._replace(coords=coords)
@@ -0,0 +1,78 @@
+'''
+Plot Bernese residual files.
+
+With no residual files the interactive plotter (ResidualPlotGui) is run.
+Otherwise each residual file is rendered to a PNG file, optionally in a
+pool of worker processes.  Large residual files are decimated (see
+Residuals.plot) so that rendering time and memory are limited.
+'''
+
+import os
+import os.path
+
+from LINZ.Bernese import Util
+
+def renderFile( filename, output=None, outputDir=None, lines=None, satellites=None, colourby=None,
+                decimate=None, size=(10.0,6.0), dpi=100, title=True ):
+    '''
+    Render a residual file to a PNG file.  The output file name defaults to
+    the residual file name with the extension replaced by .png, in outputDir
+    if it is specified.  Returns the name of the output file.
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from LINZ.Bernese.Residuals import Residuals
+
+    if output is None:
+        output=os.path.splitext(os.path.basename(filename))[0]+'.png'
+        output=os.path.join(outputDir or os.path.dirname(filename),output)
+    residuals=Residuals(filename)
+    fig=Figure(figsize=size,dpi=dpi)
+    FigureCanvasAgg(fig)
+    axes=fig.add_axes((0.08,0.1,0.77,0.82))
+    columns=max(int(size[0]*dpi),100)
+    residuals.plot(plot=axes,lines=lines,satellites=satellites,colourby=colourby,
+                   decimate=decimate,columns=columns,title=title)
+    axes.set_xlabel('Epoch (seconds)')
+    axes.set_ylabel('Residual (m)')
+    fig.savefig(output,dpi=dpi)
+    return output
+
+def main():
+    import argparse
+    parser=argparse.ArgumentParser(description='Plot Bernese residual files.  With no files the interactive plotter is run')
+    parser.add_argument('residual_files',nargs='*',help='Residual files to render to PNG files')
+    parser.add_argument('-o','--output-dir',help='Directory for PNG files (default is the residual file directory)')
+    parser.add_argument('-l','--lines',help='Space separated list of lines (baseline codes) to plot')
+    parser.add_argument('-s','--satellites',help='Space separated list of satellites to plot')
+    parser.add_argument('-c','--colour-by',choices=('lines','satellites'),help='Colour points by line or satellite')
+    parser.add_argument('-d','--decimate',choices=('none','envelope','density'),
+                        help='Decimation of points (default envelope for large files)')
+    parser.add_argument('-z','--size',type=float,nargs=2,default=(10.0,6.0),metavar=('WIDTH','HEIGHT'),
+                        help='Size of the plot in inches')
+    parser.add_argument('-r','--dpi',type=int,default=100,help='Resolution of the plot in dots per inch')
+    parser.add_argument('-w','--workers',type=int,help='Number of worker processes (0 for one per CPU)')
+    args=parser.parse_args()
+
+    if not args.residual_files:
+        try:
+            from LINZ.Bernese import ResidualPlotGui
+        except ImportError as e:
+            parser.error('The interactive plotter requires PyQt5 ('+str(e)+
+                         ') - specify residual files to render them to PNG files')
+        ResidualPlotGui.main()
+        return
+
+    if args.output_dir and not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    outputs=Util.mapfiles(renderFile,args.residual_files,workers=args.workers,
+                          outputDir=args.output_dir,lines=args.lines,satellites=args.satellites,
+                          colourby=args.colour_by,decimate=args.decimate,
+                          size=tuple(args.size),dpi=args.dpi)
+    for filename, output in zip(args.residual_files,outputs):
+        print(filename+' -> '+output)
+
+if __name__=='__main__':
+    main()
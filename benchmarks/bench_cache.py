@@ -0,0 +1,47 @@
+#!/usr/bin/python
+'''
+Benchmark of cold (parse) and warm (cached) reads of a synthetic CRD file
+using the LINZ.Bernese.Cache parse cache.
+
+Usage: python benchmarks/bench_cache.py [nstations]
+'''
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+
+from LINZ.Bernese import Cache
+from LINZ.Bernese import CoordFile
+from LINZ.Bernese import Synthetic
+from run_benchmarks import measure
+
+def timeit( func ):
+    return measure(func,repeat=5,memory=False)[0]
+
+def main():
+    nstations=int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    tmpdir=tempfile.mkdtemp()
+    try:
+        crdfile=os.path.join(tmpdir,'TEST.CRD')
+        Synthetic.writeCoordinates(crdfile,nstations,velocities=False)
+        read=lambda: CoordFile.read(crdfile,coordSet=True)
+        Cache.disable()
+        uncached=timeit(read)
+        Cache.enable(os.path.join(tmpdir,'cache'))
+        def cold():
+            Cache.clear()
+            read()
+        coldtime=timeit(cold)
+        warmtime=timeit(read)
+        print('{0} stations'.format(nstations))
+        for name,elapsed in (('no cache',uncached),('cold',coldtime),('warm',warmtime)):
+            print('{0:10s} {1:8.4f} s {2:12.0f} records/s {3:6.1f}x'.format(
+                name,elapsed,nstations/elapsed,uncached/elapsed))
+    finally:
+        Cache.disable()
+        shutil.rmtree(tmpdir)
+
+if __name__=='__main__':
+    main()
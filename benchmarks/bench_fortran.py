@@ -0,0 +1,65 @@
+#!/usr/bin/python
+'''
+Benchmark of LINZ.Bernese.Fortran.Format parsing of synthetic CRD records.
+
+Compares the original nested loop field parser with the compiled per-record
+parser (read/readiter) and the bulk parser (readarray).
+
+Usage: python benchmarks/bench_fortran.py [nrecords]
+'''
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+
+from LINZ.Bernese import Synthetic
+from LINZ.Bernese.Fortran import Format
+from run_benchmarks import measure
+
+def crdlines( nrecords ):
+    # Station records of a synthetic coordinate file
+    tmpdir=tempfile.mkdtemp()
+    try:
+        crdfile=os.path.join(tmpdir,'TEST.CRD')
+        Synthetic.writeCoordinates(crdfile,nrecords,velocities=False)
+        with open(crdfile) as f:
+            return [l for l in f.readlines()[6:] if l.strip()]
+    finally:
+        shutil.rmtree(tmpdir)
+
+def legacy_read( fmt, data ):
+    # Parser as implemented before the format was compiled
+    values = []
+    pos = 0
+    if len(data) < fmt._length:
+        data = data + ' '*(fmt._length)
+    for count, width, ftype in fmt._fields:
+        for c in range(count):
+            s = data[pos:pos+width]
+            pos += width
+            if ftype:
+                values.append(ftype(s))
+    return fmt._rectype(values)
+
+def timeit( func ):
+    return measure(func,repeat=1,memory=False)[0]
+
+def main():
+    nrecords=int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    lines=crdlines(nrecords)
+    fmt=Format('I3,2X,A16,3F15.4,4X,A1','id name X Y Z flag',True)
+    results=[
+        ('legacy read',timeit(lambda: [legacy_read(fmt,l) for l in lines])),
+        ('readiter',timeit(lambda: list(fmt.readiter(lines)))),
+        ('readarray',timeit(lambda: fmt.readarray(lines))),
+        ]
+    base=results[0][1]
+    print('{0} records'.format(nrecords))
+    for name,elapsed in results:
+        print('{0:12s} {1:8.3f} s {2:12.0f} records/s {3:6.1f}x'.format(
+            name,elapsed,nrecords/elapsed,base/elapsed))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+'''
+Benchmark suite for the LINZ.Bernese readers using synthetic files generated
+by LINZ.Bernese.Synthetic.
+
+For each size the CRD/VEL, CLU, FIX and residual files are generated in a
+temporary directory, and each benchmark reports the best elapsed time over
+the repeats, the throughput in records/second, and the peak memory allocated
+(measured with tracemalloc on a separate run).  The parse cache is disabled.
+Results can be saved as CSV to compare versions.
+
+Usage: python benchmarks/run_benchmarks.py [-s 1000 100000] [-r 1000000]
+'''
+from __future__ import print_function
+
+import argparse
+import csv
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from LINZ.Bernese import Cache
+from LINZ.Bernese import ClusterFile
+from LINZ.Bernese import CoordFile
+from LINZ.Bernese import FixFile
+from LINZ.Bernese import ResidualAnalysis
+from LINZ.Bernese import Residuals
+from LINZ.Bernese import Synthetic
+from LINZ.Bernese.Fortran import Format
+
+def measure( func, repeat=3, memory=True ):
+    '''
+    Returns the best elapsed time of repeat calls to func, and the peak 
+    memory allocated by a separate call (None if memory is False).  Used by
+    the other benchmark scripts in this directory.
+    '''
+    times=[]
+    for i in range(repeat):
+        start=time.time()
+        func()
+        times.append(time.time()-start)
+    if not memory:
+        return min(times), None
+    tracemalloc.start()
+    try:
+        func()
+        peak=tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+def coordBenchmarks( tmpdir, nstations ):
+    crdfile=os.path.join(tmpdir,'SYN{0}.CRD'.format(nstations))
+    crdfile2=os.path.join(tmpdir,'SYN{0}B.CRD'.format(nstations))
+    clufile=os.path.join(tmpdir,'SYN{0}.CLU'.format(nstations))
+    fixfile=os.path.join(tmpdir,'SYN{0}.FIX'.format(nstations))
+    coords=Synthetic.writeCoordinates(crdfile,nstations)
+    Synthetic.writeCoordinates(crdfile2,nstations,velocities=False)
+    Synthetic.writeClusters(clufile,coords,max(1,nstations//100))
+    Synthetic.writeFixed(fixfile,coords,max(1,nstations//10))
+    crdfmt=Format('I3,2X,A16,3F15.4,4X,A1','id name X Y Z flag',True)
+    return [
+        ('Format.readfilearray',nstations,
+            lambda: crdfmt.readfilearray(crdfile,skipLines=6,skipBlanks=True)),
+        ('CoordFile.read',nstations,
+            lambda: CoordFile.read(crdfile,coordSet=True)),
+        ('CoordFile.read VEL',nstations,
+            lambda: CoordFile.read(crdfile,velocities=True,coordSet=True)),
+        ('CoordFile.read dict',nstations,
+            lambda: CoordFile.read(crdfile)),
+        ('CoordFile.compare',nstations,
+            lambda: CoordFile.compare(a=crdfile,b=crdfile2)),
+        ('ClusterFile.read',nstations,
+            lambda: ClusterFile.read(clufile)),
+        ('FixFile.read',max(1,nstations//10),
+            lambda: FixFile.read(fixfile)),
+        ]
+
+def residualBenchmarks( tmpdir, nrecords ):
+    resfile=os.path.join(tmpdir,'SYN{0}.RES'.format(nrecords))
+    nsatellites=32
+    nepochs=2880
+    nlines=max(1,int(math.ceil(nrecords/(nsatellites*nepochs*0.9))))
+    nepochs=min(nepochs,max(1,int(round(nrecords/(nsatellites*nlines*0.9)))))
+    nrecords=Synthetic.writeResiduals(resfile,nlines=nlines,nepochs=nepochs,nsatellites=nsatellites)
+    res=Residuals.Residuals(resfile)
+    return [
+        ('Residuals',nrecords,lambda: Residuals.Residuals(resfile)),
+        ('Residuals.iterchunks',nrecords,lambda: sum(len(c) for c in Residuals.iterchunks(resfile))),
+        ('Residuals.stats',nrecords,lambda: res.stats()),
+        ('ResidualAnalysis.outliers',nrecords,lambda: ResidualAnalysis.outliers(res)),
+        ]
+
+def main():
+    parser=argparse.ArgumentParser(description='Benchmark the LINZ.Bernese file readers')
+    parser.add_argument('-s','--stations',type=int,nargs='+',default=[1000,10000,100000],
+                        help='Numbers of stations in the coordinate files')
+    parser.add_argument('-r','--residuals',type=int,nargs='+',default=[100000,1000000],
+                        help='Numbers of residual records in the residual files')
+    parser.add_argument('-n','--repeat',type=int,default=3,help='Number of timed repeats')
+    parser.add_argument('-c','--csv-file',help='CSV file to save the results in')
+    args=parser.parse_args()
+
+    Cache.disable()
+    tmpdir=tempfile.mkdtemp()
+    results=[]
+    try:
+        benchmarks=[]
+        for n in args.stations:
+            benchmarks.extend(coordBenchmarks(tmpdir,n))
+        for n in args.residuals:
+            benchmarks.extend(residualBenchmarks(tmpdir,n))
+        print('{0:28s} {1:>10s} {2:>10s} {3:>14s} {4:>10s}'.format(
+            'benchmark','records','time (s)','records/s','peak (MB)'))
+        for name, nrecords, func in benchmarks:
+            elapsed, peak = measure(func,args.repeat)
+            results.append((name,nrecords,elapsed,nrecords/elapsed,peak/1.0e6))
+            print('{0:28s} {1:10d} {2:10.4f} {3:14.0f} {4:10.1f}'.format(*results[-1]))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if args.csv_file:
+        with open(args.csv_file,'w') as f:
+            writer=csv.writer(f)
+            writer.writerow(('benchmark','records','time','records_per_second','peak_mb'))
+            writer.writerows(results)
+
+if __name__=='__main__':
+    main()
@@ -75,6 +75,8 @@ setup(
     # for example:
     # $ pip install -e .[dev,test]
     extras_require={
+        'spatial': ['scipy'],
+        'gui': ['PyQt5'],
     },
 
     # If there are data files included in your packages that need to be